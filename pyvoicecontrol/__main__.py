@@ -3,7 +3,7 @@ import pykka
 import argparse
 
 
-from pyvoicecontrol import config, schema, logserv, snowboy, witservice, audio_alerts, spotify, snapcast, bluetooth, input, pulse
+from pyvoicecontrol import config, schema, service, logserv, snowboy, witservice, audio_alerts, spotify, snapcast, bluetooth, input, pulse, latency
 
 from gi.repository import Gst, GObject
 from gi import require_version
@@ -18,6 +18,10 @@ sys_cfg = config.parse_config(args.config_file, schema.schema)
 
 
 def start_services(cfg):
+    service.ServiceResourceRegistry.timeout = cfg['service']['timeout']
+    service.ServiceResource.runtime = cfg['service']['runtime']
+    if cfg['latency']['enable']:
+        latency.LatencyService.start(cfg['latency'])
     if cfg['snowboy']['enable']:
         snowboy.SnowboyHotwordDetector.start(cfg['snowboy'])
     if cfg['logging']['enable']:
@@ -0,0 +1,103 @@
+import array
+import datetime
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import wave
+
+
+logger = logging.getLogger(__name__)
+
+
+class UtteranceArchive():
+    """Archives utterances as WAV files, each with a JSON file of the result,
+       from a background thread.  The oldest files are removed once there are
+       more than max_files utterances or they take up more than max_bytes.
+       Nothing ever waits on the disk, anything that can't be queued is dropped.
+    """
+    def __init__(self, directory, max_files, max_bytes, bits, rate, endian, queue_size=8):
+        self._directory = directory
+        self._max_files = max_files
+        self._max_bytes = max_bytes
+        self._bits = bits
+        self._rate = rate
+        self._endian = endian
+        self._queue = queue.Queue(queue_size)
+        self._files = []
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='UtteranceArchive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_audio(self, audio):
+        """Queues a copy of the audio, returning the name it's archived under"""
+        name = 'utterance-{:%Y%m%d-%H%M%S-%f}'.format(datetime.datetime.now())
+        self._put((name + '.wav', bytes(audio)))
+        return name
+
+    def add_result(self, name, result):
+        self._put((name + '.json', result))
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(timeout=2.0)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('Archive queue full, dropped %s', item[0])
+
+    def _run(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._files = self._scan()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+                self._rotate()
+            except:
+                logger.error('Failed to archive %s: %s', item[0], sys.exc_info())
+
+    def _scan(self):
+        files = []
+        for name in sorted(os.listdir(self._directory)):
+            if name.startswith('utterance-'):
+                files.append((name, os.path.getsize(os.path.join(self._directory, name))))
+        return files
+
+    def _write(self, name, data):
+        path = os.path.join(self._directory, name)
+        if name.endswith('.wav'):
+            if self._endian == 'big' and self._bits in (16, 32):
+                samples = array.array('h' if self._bits == 16 else 'i', data)
+                samples.byteswap()
+                data = samples.tobytes()
+            with wave.open(path, 'wb') as f:
+                f.setnchannels(1)
+                f.setsampwidth(self._bits // 8)
+                f.setframerate(self._rate)
+                f.writeframes(data)
+        else:
+            with open(path, 'w') as f:
+                json.dump(data, f)
+        self._files.append((name, os.path.getsize(path)))
+
+    def _rotate(self):
+        utterances = sorted({x[0].rsplit('.', 1)[0] for x in self._files})
+        size = sum(x[1] for x in self._files)
+        while utterances and (len(utterances) > self._max_files or (self._max_bytes and size > self._max_bytes)):
+            oldest = utterances.pop(0)
+            for x in [x for x in self._files if x[0].rsplit('.', 1)[0] == oldest]:
+                self._files.remove(x)
+                size -= x[1]
+                try:
+                    os.remove(os.path.join(self._directory, x[0]))
+                except OSError:
+                    pass
@@ -25,10 +25,10 @@ class AudioAlerts(service.ServiceResource):
         self._setup_triggers(config['triggers'])
         self._set_state_internal(forced=True)
 
-    def notify(self, path, state):
+    def notify_delta(self, path, delta, version):
         attrs = self._triggers.get(path, {})
         for a in attrs:
-            value = state.get(a, None)
+            value = delta.get(a, None)
             if value is dict:
                 for k in value:
                     d = { k: value[k] }
@@ -50,7 +50,7 @@ class AudioAlerts(service.ServiceResource):
                 value = { b: value }
             if resource not in self._triggers:
                 self._triggers[resource] = {}
-                service.ServiceStateChangeRegistry.register(self._proxy, resource)
+                service.ServiceStateChangeRegistry.register(self._proxy, resource, deltas=True)
             if attr not in self._triggers[resource]:
                 self._triggers[resource][attr] = {}
             self._triggers[resource][attr][str(value)] = f
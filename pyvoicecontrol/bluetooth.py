@@ -11,6 +11,8 @@ logger = logging.getLogger(__name__)
 
 
 class Bluetooth(service.ServiceResource):
+    blocking = True
+
     def __init__(self, config):
         super().__init__(config['path'])
         self._config = config
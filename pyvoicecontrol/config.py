@@ -102,6 +102,8 @@ def parse_config(file, schema_dict):
     output_dict = {}
 
     for section in schema_dict:
+        if not cfg.has_section(section):
+            cfg.add_section(section)
         output_dict[section] = {}
         for field in schema_dict[section]:
             validate_and_convert_types(schema_dict, cfg, section, field, output_dict)
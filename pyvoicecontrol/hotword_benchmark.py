@@ -0,0 +1,192 @@
+"""Offline hotword detection benchmark.  The configured snowboy pipeline is run
+   over a directory of labelled WAV files as fast as the CPU allows, for each
+   combination of sensitivity and VAD settings given.
+"""
+import argparse
+import glob
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+from gi import require_version
+require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from pyvoicecontrol import config, schema
+from pyvoicecontrol.snowboy import pipeline_description
+
+
+logger = logging.getLogger(__name__)
+
+
+source_description = 'filesrc location="{}" ! decodebin ! audioconvert ! audioresample ! ' \
+                     'audio/x-raw,format=S16LE,rate=16000,channels=1'
+
+
+class HotwordRun():
+    """Runs the detector pipeline over one file.  The detector's LISTENING /
+       DETECT_START cycle is followed in stream time rather than wall clock time
+       so the results don't depend on how fast the file is processed.
+    """
+    def __init__(self, cfg, path):
+        self._cfg = cfg
+        self._pipeline = Gst.parse_launch(pipeline_description(cfg, source=source_description.format(path),
+                                                               sink='fakesink sync=false'))
+        self._sb = self._pipeline.get_by_name('sb')
+        self._rm = self._pipeline.get_by_name('rm')
+        self._sb.connect('hotword-detect', self._on_hotword_detect)
+        self._sb.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self._probe)
+        self._now = 0.0
+        self._detection = None
+        self._deadline = None
+        self.detections = []
+
+    def run(self):
+        bus = self._pipeline.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect('sync-message::element', self._on_element_message)
+        self._pipeline.set_state(Gst.State.PLAYING)
+        message = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        self._pipeline.set_state(Gst.State.NULL)
+        if message.type == Gst.MessageType.ERROR:
+            raise RuntimeError(message.parse_error()[0].message)
+        if self._detection:
+            self._stop('eos')
+        return self._now
+
+    def _probe(self, pad, info):
+        buf = info.get_buffer()
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            self._now = (buf.pts + (buf.duration if buf.duration != Gst.CLOCK_TIME_NONE else 0)) / Gst.SECOND
+        if self._detection and not self._detection['speech'] and self._now > self._deadline:
+            self._stop('timeout')
+        return Gst.PadProbeReturn.OK
+
+    def _on_hotword_detect(self, obj, index):
+        if self._detection:
+            return
+        self._detection = {'time': self._now, 'speech': None, 'stop': None, 'cause': None}
+        self._deadline = self._now + self._cfg['vad_max_silence_period_sec']
+        self._sb.set_property('listen', False)
+        self._rm.set_property('gate', False)
+        self._rm.set_property('silent', False)
+
+    def _on_element_message(self, bus, message):
+        if message.src != self._rm or not self._detection:
+            return
+        s = message.get_structure().to_string()
+        if 'silence_finished' in s and not self._detection['speech']:
+            self._detection['speech'] = self._now
+            self._rm.set_property('minimum-silence-time', int(self._cfg['vad_min_silence_period_sec'] * 1000000000))
+        elif 'silence_detected' in s and self._detection['speech']:
+            self._stop('silence')
+
+    def _stop(self, cause):
+        self._detection.update(stop=self._now, cause=cause)
+        self.detections.append(self._detection)
+        self._detection = None
+        self._sb.set_property('listen', True)
+        self._rm.set_property('gate', True)
+        self._rm.set_property('silent', True)
+        self._rm.set_property('minimum-silence-time', 0)
+
+
+def score(detections, labels, tolerance):
+    """Matches detections to the labelled hotwords, returning the number found,
+       the false triggers and the endpointing errors in seconds
+    """
+    unmatched = list(detections)
+    (found, errors) = (0, [])
+    for label in labels:
+        for d in unmatched:
+            if label['hotword'] - 0.5 <= d['time'] <= label['hotword'] + tolerance:
+                unmatched.remove(d)
+                found += 1
+                if label.get('speech_end') is not None and d['cause'] == 'silence':
+                    errors.append(d['stop'] - label['speech_end'])
+                break
+    return (found, len(unmatched), errors)
+
+
+def benchmark(cfg, corpus, labels, tolerance):
+    (hotwords, found, false_triggers, aborts, errors, audio_sec) = (0, 0, 0, 0, [], 0.0)
+    cpu = time.process_time()
+    for path in corpus:
+        run = HotwordRun(cfg, path)
+        audio_sec += run.run()
+        file_labels = labels.get(os.path.basename(path), [])
+        (f, ft, e) = score(run.detections, file_labels, tolerance)
+        hotwords += len(file_labels)
+        found += f
+        false_triggers += ft
+        errors += e
+        aborts += len([x for x in run.detections if x['cause'] == 'timeout'])
+    cpu = time.process_time() - cpu
+    hours = audio_sec / 3600
+    return {
+        'sensitivity': cfg['sensitivity'],
+        'vad_threshold_db': cfg['vad_threshold_db'],
+        'vad_hysteresis': cfg['vad_hysteresis'],
+        'detection_rate': found / hotwords if hotwords else None,
+        'false_triggers_per_hour': false_triggers / hours if hours else None,
+        'aborts': aborts,
+        'endpoint_error_ms': 1000 * sum(abs(x) for x in errors) / len(errors) if errors else None,
+        'endpoint_bias_ms': 1000 * sum(errors) / len(errors) if errors else None,
+        'cpu_sec_per_audio_hour': cpu / hours if hours else None,
+        'audio_sec': audio_sec,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hotword detection and VAD over labelled WAV files')
+    parser.add_argument('--corpus', required=True,
+                        help='directory of WAV files with a labels.json giving, for each file, a list of '
+                             '{"hotword": <sec>, "speech_end": <sec>} at the end of each hotword and command')
+    parser.add_argument('--config_file', type=argparse.FileType('r'), help='take [snowboy] settings from this file')
+    parser.add_argument('--sensitivity', help='comma separated values to try')
+    parser.add_argument('--vad_threshold_db', help='comma separated values to try')
+    parser.add_argument('--vad_hysteresis', help='comma separated values to try')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='seconds after a labelled hotword a detection may occur')
+    parser.add_argument('--json', type=argparse.FileType('w'), help='write the results here')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s\t%(module)s\t%(levelname)s\t%(message)s', level=logging.WARNING)
+    Gst.init(None)
+
+    cfg = config.parse_config(args.config_file or io.StringIO(''), {'snowboy': schema.schema['snowboy']})['snowboy']
+    if '{source}' not in cfg['pipeline']:
+        print('The snowboy pipeline must start with {source} to be benchmarked')
+        sys.exit(1)
+    corpus = sorted(glob.glob(os.path.join(args.corpus, '*.wav')))
+    if not corpus:
+        print('No WAV files in {}'.format(args.corpus))
+        sys.exit(1)
+    labels = {}
+    if os.path.exists(os.path.join(args.corpus, 'labels.json')):
+        with open(os.path.join(args.corpus, 'labels.json')) as f:
+            labels = json.load(f)
+
+    sweep = [(args.sensitivity or cfg['sensitivity']).split(','),
+             [int(x) for x in (args.vad_threshold_db or str(cfg['vad_threshold_db'])).split(',')],
+             [int(x) for x in (args.vad_hysteresis or str(cfg['vad_hysteresis'])).split(',')]]
+    results = []
+    print('{:>11} {:>16} {:>14} {:>9} {:>11} {:>6} {:>14} {:>13}'.format(
+        'sensitivity', 'vad_threshold_db', 'vad_hysteresis', 'detected', 'false/hour', 'aborts', 'endpoint_ms', 'cpu_sec/hour'))
+    for (sensitivity, threshold, hysteresis) in itertools.product(*sweep):
+        result = benchmark(dict(cfg, sensitivity=sensitivity.strip(), vad_threshold_db=threshold, vad_hysteresis=hysteresis),
+                           corpus, labels, args.tolerance)
+        results.append(result)
+        print('{:>11} {:>16} {:>14} {:>9} {:>11} {:>6} {:>14} {:>13}'.format(
+            result['sensitivity'], result['vad_threshold_db'], result['vad_hysteresis'],
+            *['-' if result[k] is None else round(result[k], 2) for k in
+              ('detection_rate', 'false_triggers_per_hour', 'aborts', 'endpoint_error_ms', 'cpu_sec_per_audio_hour')]))
+    if args.json:
+        json.dump(results, args.json, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -34,24 +34,26 @@ class Input(service.ServiceResource):
         
     def update_available_inputs(self):
         devices = [evdev.InputDevice(x) for x in evdev.list_devices()]
+        available = list(self._devices)
         for x in devices:
-            if x.phys not in self._devices and \
+            if x.phys not in available and \
                 (not self._config['devices'] or \
                  (x.name in self._config['devices'] or \
                   x.path in self._config['devices'] or \
                   x.phys in self._config['devices'])):
                 logger.info('New device %s added', x.name)
-                self._devices.append(x.phys)
+                available.append(x.phys)
                 self._files[x.fileno()] = x
                 GObject.io_add_watch(x.fileno(), GObject.IO_IN | GObject.IO_ERR | GObject.IO_HUP, self.io_handler)
+        self._set_state_internal(devices=available)
         return True
 
     def io_handler(self, fd, flags):
         device = self._files[fd]
         if flags & (GObject.IO_ERR | GObject.IO_HUP):
             logger.info('Device %s removed', device.name)
-            self._devices.remove(device.phys)
             del self._files[fd]
+            self._set_state_internal(devices=[x for x in self._devices if x != device.phys])
             return False
         event = device.read_one()
         self._proxy.handle_key_event(event)
@@ -82,7 +84,7 @@ class Input(service.ServiceResource):
                 self._action = action
                 changed = True
             if devices is not None and devices != self._devices:
-                self._action = action
+                self._devices = devices
                 changed = True
         finally:
             if changed:
@@ -90,5 +92,5 @@ class Input(service.ServiceResource):
 
     def get_state(self):
         return { 'state': self._state.state,
-                 'devices': self._devices,
+                 'devices': list(self._devices),
                  'action': self._action }
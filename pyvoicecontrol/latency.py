@@ -0,0 +1,106 @@
+import bisect
+import collections
+import itertools
+import threading
+import time
+
+from . import service
+
+
+class Timeline():
+    """Records a timeline of events for each utterance.  An utterance is given a
+       correlation id when the hotword is detected, services mark events against
+       that id and the time since the hotword is added to each event's histogram.
+    """
+    buckets_ms = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+    enabled = False
+    recent = 20
+    samples = 1000
+    __ids = itertools.count(1)
+    __traces = collections.OrderedDict()
+    __histograms = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def start(cls):
+        """Starts a new utterance, returning its correlation id"""
+        utterance = next(cls.__ids)
+        if cls.enabled:
+            with cls.__lock:
+                cls.__traces[utterance] = {'utterance': utterance, 'time': time.time(),
+                                           'start': time.perf_counter(), 'events': {'hotword': 0.0}}
+                while len(cls.__traces) > cls.recent:
+                    cls.__traces.popitem(last=False)
+        return utterance
+
+    @classmethod
+    def mark(cls, utterance, event):
+        """Marks an event against an utterance, later marks of the same event are ignored"""
+        now = time.perf_counter()
+        if not cls.enabled or utterance is None:
+            return
+        with cls.__lock:
+            trace = cls.__traces.get(utterance)
+            if trace is None or event in trace['events']:
+                return
+            elapsed = round((now - trace['start']) * 1000, 1)
+            trace['events'][event] = elapsed
+            histogram = cls.__histograms.get(event)
+            if histogram is None:
+                histogram = cls.__histograms[event] = {'counts': [0] * (len(cls.buckets_ms) + 1),
+                                                       'samples': collections.deque(maxlen=cls.samples)}
+            histogram['counts'][bisect.bisect_left(cls.buckets_ms, elapsed)] += 1
+            histogram['samples'].append(elapsed)
+
+    @classmethod
+    def histograms(cls):
+        with cls.__lock:
+            output = {}
+            for (event, histogram) in cls.__histograms.items():
+                samples = sorted(histogram['samples'])
+                output[event] = {
+                    'count': sum(histogram['counts']),
+                    'buckets_ms': dict(zip([str(x) for x in cls.buckets_ms] + ['inf'], histogram['counts'])),
+                    'p50_ms': cls._percentile(samples, 50),
+                    'p95_ms': cls._percentile(samples, 95),
+                    'p99_ms': cls._percentile(samples, 99),
+                }
+            return output
+
+    @classmethod
+    def traces(cls):
+        with cls.__lock:
+            return [{'utterance': x['utterance'], 'time': x['time'], 'events_ms': dict(x['events'])}
+                    for x in cls.__traces.values()]
+
+    @classmethod
+    def reset(cls):
+        with cls.__lock:
+            cls.__traces.clear()
+            cls.__histograms.clear()
+
+    @staticmethod
+    def _percentile(samples, percent):
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class LatencyService(service.ServiceResource):
+    """Exposes the utterance timelines as histograms and recent traces"""
+    def __init__(self, config):
+        super().__init__(config['path'])
+        Timeline.recent = config['recent']
+        Timeline.samples = config['samples']
+        Timeline.enabled = True
+
+    def on_stop(self):
+        Timeline.enabled = False
+        service.ServiceResource.on_stop(self)
+
+    def set_state(self, state):
+        if state.get('reset'):
+            Timeline.reset()
+
+    def get_state(self):
+        return { 'histograms': Timeline.histograms(), 'recent': Timeline.traces() }
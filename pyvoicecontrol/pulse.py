@@ -1,4 +1,5 @@
 from . import service
+from .latency import Timeline
 import logging
 import asyncio
 import threading
@@ -9,11 +10,15 @@ logger = logging.getLogger(__name__)
 
 
 class PulseClient():
-    def __init__(self, echo_cancel=False, src_volume=None, sink_volume=None):
-        self._loop = asyncio.new_event_loop()
-        self._thread = threading.Thread(target=self._async_loop)
-        self._thread.daemon = True
-        self._thread.start()
+    def __init__(self, echo_cancel=False, src_volume=None, sink_volume=None, loop=None):
+        """Runs on loop if one is given otherwise starts its own loop and thread"""
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._async_loop)
+            self._thread.daemon = True
+            self._thread.start()
         self._pulse = pulsectl_asyncio.PulseAsync(loop=self._loop)
         asyncio.run_coroutine_threadsafe(self.pulse_task(), self._loop)
         self._src_volume = src_volume/100.0 if src_volume is not None else None
@@ -121,21 +126,30 @@ class PulseClient():
 
     def stop(self):
         future = asyncio.run_coroutine_threadsafe(self.cleanup(), self._loop)
-        future.result()
-        self._pulse.close()
+        if service.ServiceEventLoop.is_current(self._loop):
+            # Can't wait on our own loop so close once the cleanup is done
+            future.add_done_callback(lambda _: self._pulse.close())
+        else:
+            future.result()
+            self._pulse.close()
 
     
 class Pulse(service.ServiceResource):
+    priority_paths = ['/speech/detector']
+
     def __init__(self, config):
         super().__init__(config['path'])
         self._config = config
 
     def on_start(self):
         self._state = service.ServiceStateMachine(['READY'], default_state='READY')
-        self._pulse = PulseClient(self._config['echo_cancel'], self._config['src_vol'], self._config['sink_vol'])
-        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/detector')
-        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent')
-        service.ServiceStateChangeRegistry.register(self._proxy, '/input')
+        loop = service.ServiceEventLoop.get() if self.runtime == 'asyncio' else None
+        self._pulse = PulseClient(self._config['echo_cancel'], self._config['src_vol'], self._config['sink_vol'], loop=loop)
+        if self._config['volume_ducking'] and self._config['local_volume_control']:
+            service.ServiceStateChangeRegistry.register(self._proxy, '/speech/detector',
+                                                        fields={'state': {'DETECT_START', 'DETECT_STOP', 'DETECT_ABORT'}})
+        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent', fields={'state': {'INTENT'}})
+        service.ServiceStateChangeRegistry.register(self._proxy, '/input', fields={'state': {'ACTION'}})
         self._set_state_internal(force=True)
 
     def on_stop(self):
@@ -152,7 +166,8 @@ class Pulse(service.ServiceResource):
             elif state['state'] == 'DETECT_ABORT':
                 self._pulse.set_mute(self._mute_state)
         elif path == '/speech/intent' and state['state'] == 'INTENT':
-            self._proxy.process_intent(state['intent'].get('intents', []), state['intent'].get('entities', {}))
+            self._proxy.process_intent(state['intent'].get('intents', []), state['intent'].get('entities', {}),
+                                       state.get('utterance'))
         elif path == '/input' and state['state'] == 'ACTION':
             self._proxy.handle_input_action(state['action'])
 
@@ -164,7 +179,7 @@ class Pulse(service.ServiceResource):
         else:
             logger.warn('ignoring "%s" action', action)                
 
-    def process_intent(self, intents, entities):
+    def process_intent(self, intents, entities, utterance=None):
         for intent in intents:
             action = intent['name']
             if 'unmute' in action:
@@ -179,6 +194,7 @@ class Pulse(service.ServiceResource):
                 self._volume(entities)
             else:
                 logger.warn('ignoring "%s" intent', action)
+        Timeline.mark(utterance, 'pulse_action')
 
     def _volume_higher(self):
         if self._config['local_volume_control']:
@@ -4,6 +4,10 @@ enable_schema_false = {'type': bool, 'default': False }
 debug_level_schema = {'type': str, 'allowed_values': ['error', 'warn', 'info', 'debug'], 'default': 'info' }
 
 schema = {
+    'service': {
+        'timeout': {'type': float, 'default': 2.0 },
+        'runtime': {'type': str, 'allowed_values': ['threading', 'asyncio'], 'default': 'threading' },
+    },
     'logging': {
         'enable': enable_schema,
         'level': debug_level_schema,
@@ -16,27 +20,47 @@ schema = {
         'resource': {'type': str, 'default': 'common.res' },
         'model': {'type': str, 'default': 'alexa_02092017.umdl' },
         'port': {'type': int, 'default': 5050 },
+        'transport': {'type': str, 'allowed_values': ['udp', 'appsink'], 'default': 'udp' },
         'vad_hysteresis': {'type': int, 'default': 480 },
         'vad_threshold_db': {'type': int, 'default': -40 },
         'vad_min_silence_period_sec': {'type': float, 'default': 1.25 },
         'vad_max_silence_period_sec': {'type': float, 'default': 5 },
         'sensitivity': {'type': str, 'default': '0.5' },
+        'preroll_sec': {'type': float, 'default': 0 },
+        'vad_adaptive': enable_schema_false,
+        'vad_adaptive_margin_db': {'type': float, 'default': 10 },
+        'vad_noise_window_sec': {'type': float, 'default': 5 },
+        'gate': enable_schema_false,
+        'gate_threshold_db': {'type': float, 'default': -50 },
+        'gate_lookback_sec': {'type': float, 'default': 0.5 },
+        'gate_hangover_sec': {'type': float, 'default': 2 },
         'pipeline': {'type': str,
-                     'default': 'pulsesrc ! snowboy name=sb resource={} models={} sensitivity={} ! removesilence name=rm hysteresis={} remove=0 threshold={} minimum-silence-time={} silent=1 gate=1 ! udpsink host=127.0.0.1 port={} sync=false' },
+                     'default': '{source}{level} ! snowboy name=sb resource={} models={} sensitivity={} ! removesilence name=rm hysteresis={} remove=0 threshold={} minimum-silence-time={} silent=1 gate=1 ! {sink}' },
     },
     'wit_speech': {
         'enable': enable_schema,
         'path': {'type': str, 'default':'/speech/intent' },
         'port': {'type': int, 'default': 5050 },
+        'transport': {'type': str, 'allowed_values': ['udp', 'appsink'], 'default': 'udp' },
         'token': {'type': str },
-        'output_file': {'type': str, 'default': '' },
+        'archive_dir': {'type': str, 'default': '' },
+        'archive_max_files': {'type': int, 'default': 100 },
+        'archive_max_bytes': {'type': int, 'default': 50000000 },
         'content': {'type': str, 'default': 'audio/raw' },
         'encoding': {'type': str, 'default': 'signed-integer' },
         'bits': {'type': int, 'default': 16 },
         'rate': {'type': int, 'default': 16000 },
         'endian': {'type': str, 'default': 'little' },
         'url': {'type': str, 'default': 'https://api.wit.ai/speech'},
-        'tail_discard_samples': {'type': int, 'default': 0 }
+        'tail_discard_samples': {'type': int, 'default': 0 },
+        'max_utterance_sec': {'type': float, 'default': 15 },
+        'streaming': enable_schema_false,
+        'keepalive_sec': {'type': float, 'default': 0 },
+        'timeout': {'type': float, 'default': 10 },
+        'compression': {'type': str, 'allowed_values': ['none', 'flac', 'opus'], 'default': 'none' },
+        'trim_silence': enable_schema_false,
+        'trim_threshold_db': {'type': float, 'default': -45 },
+        'trim_padding_sec': {'type': float, 'default': 0.1 },
     },
     'audio_alerts': {
         'enable': enable_schema,
@@ -87,4 +111,10 @@ schema = {
         'volume_ducking': {'type': bool, 'default': False },
         'own_location': {'type': str },
     },
+    'latency': {
+        'enable': enable_schema_false,
+        'path': {'type': str, 'default':'/latency' },
+        'recent': {'type': int, 'default': 20 },
+        'samples': {'type': int, 'default': 1000 },
+    },
 }
@@ -1,5 +1,13 @@
+import asyncio
+import heapq
+import itertools
 import logging
+import queue
+import sys
+import threading
+import time
 import pykka
+import pykka.messages
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +27,7 @@ class ServiceErrors():
     UNRECOGNISED_STATE = 10
     MALFORMED_DATA_OBJECT = 11
     RESOURCE_EXCEPTION = 12
+    RESOURCE_TIMEOUT = 13
 
 
 class ServiceException(Exception):
@@ -68,24 +77,163 @@ class ServiceResourceException(ServiceException):
         self.message = message
 
 
+class ServiceResourceTimeout(ServiceException):
+    error_code = ServiceErrors.RESOURCE_TIMEOUT
+    message = 'Resource did not respond within the timeout'
+
+
+class ServicePriorityInbox(queue.Queue):
+    """Actor inbox that hands out the message with the highest priority first
+       and messages of the same priority in the order they arrived.
+    """
+    def __init__(self, priority):
+        super().__init__()
+        self._priority = priority
+        self.wakeup = None
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        if self.wakeup:
+            self.wakeup()
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._count = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, envelope):
+        heapq.heappush(self.queue, (-self._priority(envelope.message), next(self._count), envelope))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+class ServiceEventLoop():
+    """The asyncio event loop shared by all resources on the asyncio runtime.
+       It runs on its own daemon thread which is started on first use.
+    """
+    __loop = None
+    __thread = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls.__lock:
+            if cls.__loop is None:
+                cls.__loop = asyncio.new_event_loop()
+                cls.__thread = threading.Thread(target=cls.__loop.run_forever, name='ServiceEventLoop')
+                cls.__thread.daemon = True
+                cls.__thread.start()
+        return cls.__loop
+
+    @classmethod
+    def is_current(cls, loop):
+        """True when called from a callback running on loop, the shared loop is
+           the only one that runs on its own thread
+        """
+        return loop is cls.__loop and threading.current_thread() is cls.__thread
+
+
 class ServiceResource(pykka.ThreadingActor):
+    """State change notifications from any path listed in priority_paths are
+       handled ahead of all other messages waiting in the actor's inbox.
+
+       With runtime set to 'asyncio' the resource handles its messages as
+       callbacks on the shared ServiceEventLoop instead of on its own thread.
+       Resources that block while handling a message set blocking so they
+       always get their own thread.
+
+       Resources whose state changes between notifications, e.g. running
+       counters, clear cache_state so reads always go to the resource.
+    """
+    priority_paths = []
+    runtime = 'threading'
+    blocking = False
+    cache_state = True
 
     def __init__(self, path):
         """Override method to add own behaviours"""
         pykka.ThreadingActor.__init__(self)
         self._path = path
         self._proxy = self.actor_ref.proxy()
-        ServiceResourceRegistry.register(self._proxy, path)
+        ServiceResourceRegistry.register(self._proxy, path, cached=self.cache_state)
 
     def on_stop(self):
         logger.debug('[%s] stopping', self._path)
         ServiceStateChangeRegistry.unregister_all(self._proxy)
+        ServiceStateChangeRegistry.clear_state(self._path)
         ServiceResourceRegistry.unregister(self._proxy, self._path)
 
+    def _create_actor_inbox(self):
+        return ServicePriorityInbox(self._message_priority)
+
+    def _start_actor_loop(self):
+        if self.runtime == 'asyncio' and not self.blocking:
+            loop = ServiceEventLoop.get()
+            # The wakeup is installed before on_start is scheduled so no message
+            # can slip in between, but it does nothing until on_start has run
+            self._actor_loop_started = False
+            self.actor_inbox.wakeup = lambda: self._actor_loop_started and \
+                loop.call_soon_threadsafe(self._actor_loop_step)
+            loop.call_soon_threadsafe(self._actor_loop_start, loop)
+        else:
+            pykka.ThreadingActor._start_actor_loop(self)
+
+    def _actor_loop_start(self, loop):
+        try:
+            self.on_start()
+        except Exception:
+            self._handle_failure(*sys.exc_info())
+        # Messages that arrived before on_start finished, set the flag first so
+        # anything put after the count is taken is woken up instead
+        self._actor_loop_started = True
+        for _ in range(self.actor_inbox.qsize()):
+            loop.call_soon(self._actor_loop_step)
+
+    def _actor_loop_step(self):
+        """Handles a single message in the same way as the pykka threading loop"""
+        try:
+            envelope = self.actor_inbox.get_nowait()
+        except queue.Empty:
+            return
+        if not self.actor_stopped.is_set():
+            try:
+                response = self._handle_receive(envelope.message)
+                if envelope.reply_to is not None:
+                    envelope.reply_to.set(response)
+            except Exception:
+                if envelope.reply_to is not None:
+                    envelope.reply_to.set_exception()
+                else:
+                    self._handle_failure(*sys.exc_info())
+                    try:
+                        self.on_failure(*sys.exc_info())
+                    except Exception:
+                        self._handle_failure(*sys.exc_info())
+        elif envelope.reply_to is not None:
+            if isinstance(envelope.message, pykka.messages._ActorStop):
+                envelope.reply_to.set(None)
+            else:
+                error = pykka.ActorDeadError('{} stopped before handling the message'.format(self.actor_ref))
+                envelope.reply_to.set_exception(exc_info=(pykka.ActorDeadError, error, None))
+
+    def _message_priority(self, message):
+        if isinstance(message, pykka.messages.ProxyCall) and \
+           message.attr_path[-1] in ('notify', 'notify_delta') and \
+           message.args and message.args[0] in self.priority_paths:
+            return 1
+        return 0
+
     def notify(self, path, state):
         """Implemented by child"""
         raise ServiceMethodNotImplemented
 
+    def notify_delta(self, path, delta, version):
+        """Implemented by child if registered for deltas"""
+        raise ServiceMethodNotImplemented
+
     def set_state(self, state):
         """Implemented by child"""
         raise ServiceMethodNotImplemented
@@ -99,130 +247,523 @@ class ServiceResource(pykka.ThreadingActor):
         raise ServiceMethodNotImplemented
 
 
+class ServicePathNode():
+    def __init__(self, children=None, value=None):
+        self.children = children or {}
+        self.value = value
+
+
+class ServicePathTrie():
+    """Resource paths indexed by their path segments e.g., '/speech/detector'
+       is stored under the node chain 'speech' -> 'detector'.  A lookup only
+       visits the nodes along the path and the subtree beneath it.
+
+       The trie is never modified once built.  Both insert() and remove() return
+       a new trie that shares every untouched node with the original, so any
+       reader holding a reference always sees a consistent snapshot.
+    """
+    def __init__(self, root=None):
+        self._root = root or ServicePathNode()
+
+    @staticmethod
+    def split(path):
+        return [x for x in path.split('/') if x]
+
+    def find(self, path):
+        node = self._root
+        for i in self.split(path):
+            node = node.children.get(i, None)
+            if node is None:
+                break
+        return node
+
+    def get(self, path):
+        node = self.find(path)
+        return node.value if node else None
+
+    def insert(self, path, value):
+        return ServicePathTrie(self._insert(self._root, self.split(path), value))
+
+    def _insert(self, node, segments, value):
+        if not segments:
+            return ServicePathNode(node.children if node else None, value)
+        children = dict(node.children) if node else {}
+        children[segments[0]] = self._insert(children.get(segments[0], None), segments[1:], value)
+        return ServicePathNode(children, node.value if node else None)
+
+    def remove(self, path):
+        return ServicePathTrie(self._remove(self._root, self.split(path)))
+
+    def _remove(self, node, segments):
+        if node is None:
+            return None
+        if not segments:
+            node = ServicePathNode(node.children, None)
+        else:
+            children = dict(node.children)
+            child = self._remove(children.pop(segments[0], None), segments[1:])
+            if child is not None:
+                children[segments[0]] = child
+            node = ServicePathNode(children, node.value)
+        # Prune any branches that no longer lead to a value
+        return node if node.value is not None or node.children else None
+
+    def walk(self, node=None, path=None):
+        """Yields (path segments, value) for every value at or beneath node"""
+        node = node or self._root
+        path = path or []
+        if node.value is not None:
+            yield (path, node.value)
+        for i in node.children:
+            yield from self.walk(node.children[i], path + [i])
+
+    def trace(self, path):
+        """Yields (remaining path segments, value) for every value on the way
+           from the root down to path i.e., path itself and all its parents
+        """
+        segments = self.split(path)
+        node = self._root
+        for n in range(len(segments) + 1):
+            if node.value is not None:
+                yield (segments[n:], node.value)
+            if n == len(segments):
+                break
+            node = node.children.get(segments[n], None)
+            if node is None:
+                break
+
+    def items(self):
+        for (path, value) in self.walk():
+            yield ('/' + '/'.join(path), value)
+
+
 class ServiceResourceRegistry():
-    __registry = {}
+    __registry = ServicePathTrie()
+    __uncached = frozenset()
+    __lock = threading.Lock()
+    timeout = 2.0
 
     @classmethod
-    def register(cls, obj, resource):
-        if resource in cls.__registry:
-            raise ServiceException('Resource path conflict - {} already exists'.format(resource))
-        cls.__registry[resource] = obj
+    def register(cls, obj, resource, cached=True):
+        """Reads of a resource registered with cached unset are never served
+           from its last notified state
+        """
+        with cls.__lock:
+            if cls.__registry.get(resource) is not None:
+                raise ServiceException('Resource path conflict - {} already exists'.format(resource))
+            cls.__registry = cls.__registry.insert(resource, obj)
+            if not cached:
+                cls.__uncached = cls.__uncached | {cls._join(resource, [])}
 
     @classmethod
     def unregister(cls, obj, resource=None):
-        if resource:
-            cls.__registry.pop(resource, None)
-        else:
-            for r in cls.__registry:
-                if cls.__registry[r] == obj:
-                    cls.__registry.pop(r, None)
+        with cls.__lock:
+            registry = cls.__registry
+            if resource:
+                registry = registry.remove(resource)
+                removed = {cls._join(resource, [])}
+            else:
+                removed = set()
+                for (r, o) in cls.__registry.items():
+                    if o == obj:
+                        registry = registry.remove(r)
+                        removed.add(r)
+            cls.__registry = registry
+            cls.__uncached = cls.__uncached - removed
 
     @classmethod
-    def set_resource(cls, resource, data):
+    def set_resource(cls, resource, data, timeout=None):
+        """Every matching resource is set in parallel.  Returns a dict of resource
+           path to ServiceSuccess or the exception raised by that resource.
+        """
         objs = cls._lookup(resource)
         if not objs:
             raise ServiceResourceDoesNotExist
+        pending = []
         for (path, obj) in objs:
-            if path:
-                z = data
-                for i in path:
-                    if i in z:
-                        z = z[i]
-                    else:
-                        z = None
-                        break
-                if z:
-                    obj.set_state(z)
-            else:
-                obj.set_state(data).get()
+            z = data
+            for i in path:
+                if i in z:
+                    z = z[i]
+                else:
+                    z = None
+                    break
+            if z or not path:
+                pending.append((path, obj.set_state(z)))
+        results = cls._gather([f for (_, f) in pending], timeout)
+        response = {}
+        for ((path, _), (_, error)) in zip(pending, results):
+            if error and not path:
+                raise error
+            response[cls._join(resource, path)] = error if error else ServiceSuccess()
+        return response
 
     @classmethod
     def delete_resources(cls, resources):
+        registry = cls.__registry
         for r in resources:
-            if r not in cls.__registry:
+            if registry.get(r) is None:
                 raise ServiceResourceDoesNotExist
         for r in resources:
-            if r in cls.__registry:
-                obj = cls.__registry[r]
+            obj = registry.get(r)
+            if obj is not None:
                 obj.delete().get()
 
     @classmethod
-    def get_resource(cls, resource):
+    def get_resource(cls, resource, timeout=None, fresh=False):
+        """Resources are read from the last state they notified, so a read does
+           not have to wait on the actor.  Resources that have not notified yet or
+           aren't cached, or all resources when fresh is set, are read from the
+           actors in parallel.
+           A resource that fails or does not respond within timeout is reported
+           with its last known state and 'stale' set.
+        """
         objs = cls._lookup(resource)
         if not objs:
             raise ServiceResourceDoesNotExist
-        data = {}
+        uncached = cls.__uncached
+        reads = []
         for (path, obj) in objs:
+            full = cls._join(resource, path)
+            cached = ServiceStateChangeRegistry.last_state(full)
+            reads.append((path, obj, cached,
+                          None if cached is not None and not fresh and full not in uncached else obj.get_state()))
+        pending = [f for (_, _, _, f) in reads if f]
+        results = iter(cls._gather(pending, timeout)) if pending else iter(())
+        data = {}
+        for (path, obj, state, future) in reads:
+            if future:
+                (result, error) = next(results)
+                if error:
+                    logger.warning('[%s] %s', cls._join(resource, path), error.message)
+                    if not path and state is None:
+                        raise error
+                    state = dict(state or {}, stale=True)
+                else:
+                    state = result
             if path:
                 z = data
-                for i in path:
-                    p = z
-                    if i not in z:
-                        z[i] = {}
-                        z = z[i]
-                p[i] = obj.get_state().get()
+                for i in path[:-1]:
+                    z = z.setdefault(i, {})
+                z[path[-1]] = state
             else:
-                return obj.get_state().get()
+                return state
         return data
 
+    @classmethod
+    def _gather(cls, futures, timeout=None):
+        """All futures have already been issued so timeout applies to each resource
+           in parallel.  Returns a (result, exception) tuple per future.
+        """
+        deadline = time.monotonic() + (cls.timeout if timeout is None else timeout)
+        results = []
+        for f in futures:
+            try:
+                results.append((f.get(timeout=max(0, deadline - time.monotonic())), None))
+            except pykka.Timeout:
+                results.append((None, ServiceResourceTimeout()))
+            except ServiceException as e:
+                results.append((None, e))
+            except Exception as e:
+                results.append((None, ServiceResourceException(str(e))))
+        return results
+
+    @staticmethod
+    def _join(resource, path):
+        return '/' + '/'.join(ServicePathTrie.split(resource) + path)
+
     @classmethod
     def _lookup(cls, resource):
-        objs = []
         if not resource:
-            return objs
-        for k in cls.__registry:
-            if k == resource or resource == '/' or (k.startswith(resource) and k[len(resource)] == '/'):
-                path = [x for x in k[len(resource):].split('/') if x]
-                objs.append((path, cls.__registry[k]))
-        return objs
+            return []
+        registry = cls.__registry
+        node = registry.find(resource)
+        return list(registry.walk(node)) if node else []
+
+
+def state_delta(old, new):
+    """Returns the keys of new whose values differ from old.  Nested dicts are
+       compared key by key and keys that no longer exist are returned as None.
+    """
+    if not isinstance(old, dict):
+        return dict(new)
+    delta = {}
+    for k in new:
+        if k not in old:
+            delta[k] = new[k]
+        elif new[k] != old[k]:
+            if isinstance(new[k], dict) and isinstance(old[k], dict):
+                delta[k] = state_delta(old[k], new[k])
+            else:
+                delta[k] = new[k]
+    for k in old:
+        if k not in new:
+            delta[k] = None
+    return delta
+
+
+def merge_delta(old, new):
+    """Folds the later delta new into old"""
+    merged = dict(old)
+    for k in new:
+        if isinstance(new[k], dict) and isinstance(merged.get(k, None), dict):
+            merged[k] = merge_delta(merged[k], new[k])
+        else:
+            merged[k] = new[k]
+    return merged
+
+
+class ServiceCoalescer():
+    """Compacts the notifications sent to a single subscription.  Changes that
+       arrive within period seconds of each other are held back and only the
+       latest is sent (deltas are merged) at the end of the period.  With the
+       'latest' policy every change waits for the end of its period, whereas
+       'rate' sends a change straight away if nothing was sent during the last
+       period i.e., at most one notification per period.
+    """
+    policies = ['latest', 'rate']
+
+    def __init__(self, policy, period):
+        if policy not in self.policies:
+            raise ServiceException('Unrecognised coalesce policy {}'.format(policy))
+        self._policy = policy
+        self._period = period
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._last_sent = 0
+
+    def post(self, resource, data, version, send, merge=None):
+        with self._lock:
+            now = time.monotonic()
+            if self._policy == 'rate' and not self._timer and now - self._last_sent >= self._period:
+                self._last_sent = now
+            else:
+                if merge and resource in self._pending:
+                    data = merge(self._pending[resource][0], data)
+                self._pending[resource] = (data, version, send)
+                if not self._timer:
+                    self._timer = threading.Timer(max(0, self._last_sent + self._period - now) \
+                                                  if self._policy == 'rate' else self._period, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        send(resource, data, version)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+            self._last_sent = time.monotonic()
+        for resource in pending:
+            (data, version, send) = pending[resource]
+            try:
+                send(resource, data, version)
+            except pykka.ActorDeadError:
+                pass
+
+    def cancel(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = None
+            self._pending = {}
+
+
+class ServiceSubscription():
+    def __init__(self, app, deltas=False, fields=None, coalesce=None, period=0):
+        self.app = app
+        self.deltas = deltas
+        self.fields = fields
+        self.coalescer = ServiceCoalescer(coalesce, period) if coalesce else None
+        self._sent = None
+        self._lock = threading.Lock()
+
+    def matches(self, state):
+        """A state matches when each field in fields has one of its allowed values"""
+        if self.fields:
+            for (k, allowed) in self.fields.items():
+                if state.get(k, None) not in allowed:
+                    return False
+        return True
+
+    def delta(self, state):
+        """A subscription with fields skips states, so its deltas are taken
+           from the last state it was sent rather than the last state notified
+        """
+        with self._lock:
+            (previous, self._sent) = (self._sent, state)
+        return state_delta(previous, state)
+
+    def send(self, resource, data, version):
+        if self.coalescer:
+            self.coalescer.post(resource, data, version, self._send, merge_delta if self.deltas else None)
+        else:
+            self._send(resource, data, version)
+
+    def _send(self, resource, data, version):
+        if self.deltas:
+            self.app.notify_delta(resource, data, version)
+        else:
+            self.app.notify(resource, data)
+
+    def cancel(self):
+        if self.coalescer:
+            self.coalescer.cancel()
 
 
 class ServiceStateChangeRegistry():
-    __registry = {}
+    __registry = ServicePathTrie()
+    __lock = threading.Lock()
+    __states = {}
+    __states_lock = threading.Lock()
 
     @classmethod
     def notify(cls, resource, state):
-        def _notify(resource, state):
-            """Evaluate each resource and assess if it is parent or same level
-            in the resource tree.  For each matching entry in the register, we
-            need to notify the state change event
-            """
-            for (this_app, context) in cls.__registry:
-                target = cls.__registry[(this_app, context)]
-                if resource == target or target == '/' or (resource.startswith(target) and \
-                                                           resource[len(target)] == '/'):
-                    def expand(path, s):
-                        """Expands a dict iteratively to depth of path"""
-                        d = {}
-                        z = d
-                        p = None
-                        for i in path:
-                            p = z
-                            z[i] = {}
-                            z = z[i]
-                        if p:
-                            p[i] = s
-                        else:
-                            d = s
-                        return d
-                    path = [x for x in resource[len(target):].split('/') if x]
-                    data = expand(path, state)
-                    this_app.notify(resource, data)
-        _notify(resource, state)
-
-    @classmethod
-    def register(cls, this_app, resource):
-        cls.__registry[(this_app, resource)] = resource
+        """Only the subscriptions on the path from the root of the resource tree
+        down to the resource are visited i.e., those that are a parent or same
+        level in the resource tree.  The expanded state is built once for each
+        subscription path and shared by all its subscribers.
+
+        Subscribers registered for deltas are instead sent the keys that changed
+        since the last notify (or, with fields, since the last state they were
+        sent) along with the version number of the state, and are not notified
+        at all when nothing changed.  Subscribers registered
+        with fields are only notified when the state matches them, so nothing is
+        posted to their mailbox for states they would ignore.  Subscribers with a
+        coalesce policy get a compacted stream, see ServiceCoalescer.
+        """
+        # A resource may notify from more than one thread, each notify must get
+        # its own version and the state it replaced
+        with cls.__states_lock:
+            (version, previous) = cls.__states.get(resource, (0, None))
+            version += 1
+            cls.__states[resource] = (version, state)
+        delta = None
+        for (path, subscriptions) in cls.__registry.trace(resource):
+            data = None
+            changes = None
+            for s in subscriptions:
+                if not s.matches(state):
+                    continue
+                if s.deltas and s.fields:
+                    own = s.delta(state)
+                    if own:
+                        s.send(resource, cls._expand(path, own), version)
+                elif s.deltas:
+                    if delta is None:
+                        delta = state_delta(previous, state)
+                    if not delta:
+                        continue
+                    if changes is None:
+                        changes = cls._expand(path, delta)
+                    s.send(resource, changes, version)
+                else:
+                    if data is None:
+                        data = cls._expand(path, state)
+                    s.send(resource, data, version)
+
+    @classmethod
+    def last_state(cls, resource):
+        """The last state notified for resource or None"""
+        return cls.__states.get(resource, (0, None))[1]
+
+    @classmethod
+    def version(cls, resource):
+        """Incremented on every notify for resource, 0 if never notified"""
+        return cls.__states.get(resource, (0, None))[0]
+
+    @classmethod
+    def clear_state(cls, resource):
+        cls.__states.pop(resource, None)
+
+    @staticmethod
+    def _expand(path, state):
+        """Expands a dict iteratively to depth of path"""
+        for i in reversed(path):
+            state = { i: state }
+        return state
+
+    @classmethod
+    def register(cls, this_app, resource, deltas=False, fields=None, coalesce=None, period=0):
+        """Subscribe this_app to state changes of resource and any resource beneath
+           it.  With deltas set, changes are sent to this_app.notify_delta() rather
+           than the full state to this_app.notify().  The fields dict filters which
+           states are sent e.g., { 'state': {'DETECT_START', 'DETECT_STOP'} }.  The
+           coalesce policy ('latest' or 'rate') compacts changes arriving within
+           period seconds of each other.
+        """
+        subscription = ServiceSubscription(this_app, deltas=deltas, fields=fields, coalesce=coalesce, period=period)
+        with cls.__lock:
+            subscriptions = cls.__registry.get(resource) or ()
+            for x in subscriptions:
+                if x.app == this_app:
+                    x.cancel()
+            subscriptions = tuple(x for x in subscriptions if x.app != this_app)
+            cls.__registry = cls.__registry.insert(resource, subscriptions + (subscription,))
 
     @classmethod
     def unregister(cls, this_app, resource):
-        cls.__registry.pop((this_app, resource))
+        with cls.__lock:
+            subscriptions = cls.__registry.get(resource) or ()
+            if not any(x.app == this_app for x in subscriptions):
+                raise KeyError((this_app, resource))
+            cls.__registry = cls._without(cls.__registry, this_app, resource, subscriptions)
 
     @classmethod
     def unregister_all(cls, this_app):
-        for (app, context) in list(cls.__registry):
-            if app == this_app:
-                del cls.__registry[(app, context)]
+        with cls.__lock:
+            registry = cls.__registry
+            for (resource, subscriptions) in cls.__registry.items():
+                if any(x.app == this_app for x in subscriptions):
+                    registry = cls._without(registry, this_app, resource, subscriptions)
+            cls.__registry = registry
+
+    @staticmethod
+    def _without(registry, this_app, resource, subscriptions):
+        for x in subscriptions:
+            if x.app == this_app:
+                x.cancel()
+        subscriptions = tuple(x for x in subscriptions if x.app != this_app)
+        return registry.insert(resource, subscriptions) if subscriptions else registry.remove(resource)
+
+
+class ServiceChannelRegistry():
+    """In-process channels that hand bulk data, e.g. audio, from one service
+       straight to a consumer in another.  Channels are keyed by port so they
+       can stand in for a loopback UDP socket.
+    """
+    __consumers = {}
+    __dropped = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, port, consumer):
+        with cls.__lock:
+            cls.__consumers[port] = consumer
+
+    @classmethod
+    def disconnect(cls, port, consumer):
+        with cls.__lock:
+            if cls.__consumers.get(port) == consumer:
+                del cls.__consumers[port]
+
+    @classmethod
+    def send(cls, port, data):
+        """Calls the consumer on the sender's thread, data is counted as dropped
+           when there is no consumer
+        """
+        consumer = cls.__consumers.get(port)
+        if consumer is None:
+            with cls.__lock:
+                cls.__dropped[port] = cls.__dropped.get(port, 0) + len(data)
+            return False
+        consumer(data)
+        return True
+
+    @classmethod
+    def dropped(cls, port):
+        return cls.__dropped.get(port, 0)
 
 
 class ServiceStateMachine():
@@ -1,4 +1,5 @@
 from . import service
+from .latency import Timeline
 import logging
 import snapcast.control
 import asyncio
@@ -8,18 +9,29 @@ logger = logging.getLogger(__name__)
 
 
 class Snapcast(service.ServiceResource):
+    priority_paths = ['/speech/detector']
+
     def __init__(self, config):
         super().__init__(config['path'])
         self._config = config
         self._state = service.ServiceStateMachine(['READY'], default_state='READY')
         self._set_state_internal(force=True)
-        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/detector')
-        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent')
-        service.ServiceStateChangeRegistry.register(self._proxy, '/input')
-        self._loop = asyncio.get_event_loop()
-        self._server = self._loop.run_until_complete(snapcast.control.create_server(self._loop, config['server']))
+        if self._config['volume_ducking'] and self._config['local_volume_control']:
+            service.ServiceStateChangeRegistry.register(self._proxy, '/speech/detector',
+                                                        fields={'state': {'DETECT_START', 'DETECT_STOP', 'DETECT_ABORT'}})
+        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent', fields={'state': {'INTENT'}})
+        service.ServiceStateChangeRegistry.register(self._proxy, '/input', fields={'state': {'ACTION'}})
+        if self.runtime == 'asyncio':
+            self._loop = service.ServiceEventLoop.get()
+            self._server = asyncio.run_coroutine_threadsafe(snapcast.control.create_server(self._loop, config['server']),
+                                                            self._loop).result()
+        else:
+            self._loop = asyncio.get_event_loop()
+            self._server = self._loop.run_until_complete(snapcast.control.create_server(self._loop, config['server']))
         self._client = self._server.client(config['own_location'])
         self._mute_state = self._client.muted
+        self._volume_requests = 0
+        self._requested_volume = None
 
     def notify(self, path, state):
         if path == '/speech/detector' and self._config['volume_ducking'] and self._config['local_volume_control']:
@@ -31,7 +43,8 @@ class Snapcast(service.ServiceResource):
             elif state['state'] == 'DETECT_ABORT':
                 self._mute(self._mute_state)
         elif path == '/speech/intent' and state['state'] == 'INTENT':
-            self._proxy.process_intent(state['intent'].get('intents', []), state['intent'].get('entities', {}))
+            self._proxy.process_intent(state['intent'].get('intents', []), state['intent'].get('entities', {}),
+                                       state.get('utterance'))
         elif path == '/input' and state['state'] == 'ACTION':
             self._proxy.handle_input_action(state['action'])
 
@@ -43,7 +56,7 @@ class Snapcast(service.ServiceResource):
         else:
             logger.warn('ignoring "%s" action', action)                
 
-    def process_intent(self, intents, entities):
+    def process_intent(self, intents, entities, utterance=None):
         for intent in intents:
             action = intent['name']
             if 'unmute' in action:
@@ -58,18 +71,19 @@ class Snapcast(service.ServiceResource):
                 self._volume(entities)
             else:
                 logger.warn('ignoring "%s" intent', action)
+        Timeline.mark(utterance, 'snapcast_action')
 
     def _volume_higher(self):
         if self._config['local_volume_control']:
-            level = min(100, self._client.volume + self._config['volume_step_size'])
+            level = min(100, self._current_volume() + self._config['volume_step_size'])
             logger.info('set volume louder (+%s->%s) in %s', self._config['volume_step_size'], level, self._config['own_location'])
-            self._loop.run_until_complete(self._client.set_volume(level))
+            self._set_volume(level)
 
     def _volume_lower(self):
         if self._config['local_volume_control']:
-            level = max(0, self._client.volume - self._config['volume_step_size'])
+            level = max(0, self._current_volume() - self._config['volume_step_size'])
             logger.info('set volume quieter (-%s->%s) in %s', self._config['volume_step_size'], level, self._config['own_location'])
-            self._loop.run_until_complete(self._client.set_volume(level))
+            self._set_volume(level)
         
     def _volume(self, entities):
         locations = entities.get('room:room', [])
@@ -81,15 +95,52 @@ class Snapcast(service.ServiceResource):
                     location = y['value']
                     client = self._server.client(location)
                     logger.info('set volume %s in %s', level, location)
-                    self._loop.run_until_complete(client.set_volume(level))
+                    self._run(client.set_volume(level))
             else:
                 if self._config['local_volume_control']:
                     logger.info('set volume %s in %s', level, self._config['own_location'])
-                    self._loop.run_until_complete(self._client.set_volume(level))
+                    self._set_volume(level)
 
     def _mute(self, state):
         if self._config['local_volume_control']:
-            self._loop.run_until_complete(self._client.set_muted(state))
+            self._run(self._client.set_muted(state))
+
+    def _current_volume(self):
+        """Requests queued on the shared event loop haven't updated the client
+           yet, so volume steps are taken from the last volume requested
+        """
+        return self._requested_volume if self._volume_requests else self._client.volume
+
+    def _set_volume(self, level):
+        self._requested_volume = level
+        self._volume_requests += 1
+        self._run(self._client.set_volume(level), self._volume_done)
+
+    def _volume_done(self):
+        self._volume_requests -= 1
+
+    def _run(self, coro, done=None):
+        """The shared event loop is already running so requests are queued on
+           it, otherwise they are run to completion on our own loop
+        """
+        if self.runtime == 'asyncio':
+            future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+            future.add_done_callback(lambda f: self._request_done(f, done))
+        else:
+            try:
+                self._loop.run_until_complete(coro)
+            finally:
+                if done:
+                    done()
+
+    @staticmethod
+    def _request_done(future, done):
+        if done:
+            done()
+        if future.cancelled():
+            logger.warning('Snapcast request cancelled')
+        elif future.exception():
+            logger.error('Snapcast request failed: %s', future.exception())
 
     def _set_state_internal(self, state=None, force=False):
         """Use this to actuate state changes and notify other listeners
@@ -1,11 +1,17 @@
 from gi import require_version
 require_version('Gst', '1.0')
-from gi.repository import Gst, GObject
+from gi.repository import Gst, GObject, GLib
 
+import collections
 import logging
 import os
+import re
+import socket
+import sys
 
 from . import service
+from .schema import schema
+from .latency import Timeline
 
 
 logger = logging.getLogger(__name__)
@@ -14,33 +20,361 @@ logger = logging.getLogger(__name__)
 models_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/models/'
 
 
+def sink_description(config):
+    if config['transport'] == 'appsink':
+        return 'appsink name=out sync=false emit-signals=true'
+    return 'udpsink host=127.0.0.1 port={} sync=false'.format(config['port'])
+
+
+def level_description(config):
+    """The level element is only needed by the adaptive VAD threshold and the gate"""
+    if config['vad_adaptive'] or config['gate']:
+        return ' ! level name=lv interval=100000000'
+    return ''
+
+
+def pipeline_description(config, source='pulsesrc', sink=None):
+    """Fills in the configured pipeline.  The source and sink can be replaced
+       e.g., to run the detector over recorded audio.
+    """
+    return config['pipeline'].format(models_dir + config['resource'],
+                                     models_dir + config['model'],
+                                     config['sensitivity'],
+                                     config['vad_hysteresis'],
+                                     config['vad_threshold_db'],
+                                     0,
+                                     config['port'],
+                                     source=source,
+                                     level=level_description(config),
+                                     sink=sink if sink else sink_description(config))
+
+
+class SnowboyPipeline():
+    """A detector pipeline, its named elements and the audio its probes hold back"""
+    def __init__(self, description, settings):
+        self.pipeline = Gst.parse_launch(description)
+        self.settings = settings
+        self.playing = False
+        self.failed = False
+        self.sb = self.pipeline.get_by_name('sb')
+        self.rm = self.pipeline.get_by_name('rm')
+        self.lv = self.pipeline.get_by_name('lv')
+        self.out = self.pipeline.get_by_name('out')
+        self.address = None
+        self.preroll = collections.deque()
+        self.preroll_bytes = 0
+        self.preroll_limit = None
+        self.preroll_flush = False
+        self.gate = collections.deque()
+        self.gate_sec = 0.0
+        self.gate_remaining = 0.0
+        self.gate_pushing = False
+
+
 class SnowboyHotwordDetector(service.ServiceResource):
+    """Settings in live_settings are applied to the running pipeline, changing
+       any of rebuild_settings builds a new pipeline which replaces the running
+       one once it is capturing.  Nothing waits for a pipeline to start, the
+       replacement is made when its bus reports it is playing.
+    """
+    live_settings = ['sensitivity', 'vad_threshold_db', 'vad_hysteresis', 'vad_min_silence_period_sec',
+                     'vad_max_silence_period_sec', 'vad_adaptive', 'vad_adaptive_margin_db',
+                     'gate_threshold_db', 'gate_lookback_sec', 'gate_hangover_sec']
+    rebuild_settings = ['model', 'resource']
+    restart_delay_sec = 1.0
+
     def __init__(self, config):
+        # The gate counters change on every buffer
+        self.cache_state = not config['gate']
         super().__init__(config['path'])
         self._state = service.ServiceStateMachine(['LISTENING', 'DETECT_START', 'DETECT_ABORT', 'DETECT_STOP'], default_state='LISTENING')
-        self._config = config
+        self._config = dict(config)
+        self._utterance = None
 
     def on_start(self):
         self._timeout = None
-        self._pipeline = Gst.parse_launch(self._config['pipeline'].format(models_dir + self._config['resource'],
-                                                                   models_dir + self._config['model'],
-                                                                   self._config['sensitivity'],
-                                                                   self._config['vad_hysteresis'],
-                                                                   self._config['vad_threshold_db'],
-                                                                   0,
-                                                                   self._config['port']))
-        self._pipeline.set_state(Gst.State.PLAYING)
-        self._sb = self._pipeline.get_by_name('sb')
-        self._sb.connect('hotword-detect', self._on_hotword_detect)
-        self._rm = self._pipeline.get_by_name('rm')
+        self._restart = None
+        self._rebuild = False
         self._activity_detected = False
-        bus = self._pipeline.get_bus()
+        self._noise = collections.deque(maxlen=max(1, int(self._config['vad_noise_window_sec'] * 10)))
+        self._noise_floor = None
+        self._vad_threshold = self._config['vad_threshold_db']
+        self._fed_sec = 0.0
+        self._total_sec = 0.0
+        self._udp = None
+        if self._config['preroll_sec'] > 0 and self._config['transport'] == 'udp':
+            self._udp = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._current = None
+        self._pending = None
+        self._start_pipeline()
+        self._set_state_internal(force=True)
+
+    def on_stop(self):
+        if self._restart:
+            GObject.source_remove(self._restart)
+        for p in (self._pending, self._current):
+            if p:
+                self._stop_pipeline(p)
+        service.ServiceResource.on_stop(self)
+
+    def _build_pipeline(self):
+        p = SnowboyPipeline(pipeline_description(self._config),
+                            { k: self._config[k] for k in self.rebuild_settings })
+        if p.out:
+            p.out.connect('new-sample', self._on_new_sample)
+        elif self._config['transport'] == 'appsink':
+            logger.warning('No appsink named "out" in pipeline, audio is not handed off')
+        p.sb.connect('hotword-detect', self._on_hotword_detect)
+        if self._config['vad_adaptive'] and not p.lv:
+            logger.warning('No level element named "lv" in pipeline, VAD threshold is not adapted')
+        if self._config['gate']:
+            if p.lv:
+                p.lv.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._gate_probe, p)
+            else:
+                logger.warning('No level element named "lv" in pipeline, hotword detection is not gated')
+        if self._udp:
+            p.address = self._udp_address(p.pipeline)
+        if self._config['preroll_sec'] > 0:
+            p.rm.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self._preroll_probe, p)
+        bus = p.pipeline.get_bus()
         bus.add_signal_watch()
-        bus.connect('message', self._on_bus_message)
+        bus.connect('message', self._on_bus_message, p)
+        if self._config['gate'] and p.lv:
+            bus.enable_sync_message_emission()
+            bus.connect('sync-message::element', self._on_sync_message, p)
+        return p
+
+    def _start_pipeline(self):
+        """The new pipeline is left pending until it is capturing, see
+           _on_pipeline_playing, so no audio is missed while it starts
+        """
+        p = self._build_pipeline()
+        if self._pending:
+            self._stop_pipeline(self._pending)
+        self._pending = p
+        if not self._current:
+            self._replace_pipeline()
+        p.pipeline.set_state(Gst.State.PLAYING)
+
+    def _replace_pipeline(self):
+        (old, self._current, self._pending) = (self._current, self._pending, None)
+        (self._sb, self._rm, self._lv) = (self._current.sb, self._current.rm, self._current.lv)
+        if old:
+            self._stop_pipeline(old)
+
+    def _on_pipeline_playing(self, p):
+        """The pending pipeline replaces the running one, unless an utterance is
+           being recorded in which case it waits for the detector to return to
+           LISTENING
+        """
+        p.playing = True
+        if p is self._pending and self._state.state == 'LISTENING':
+            self._replace_pipeline()
+            logger.info('Capture pipeline started')
+
+    def _on_pending_failed(self, p, reason):
+        """A replacement pipeline that fails is discarded.  A running pipeline
+           that is still healthy is kept along with the settings it was built with.
+        """
+        self._pending = None
+        self._stop_pipeline(p)
+        if self._current.failed:
+            logger.error('Capture pipeline %s', reason)
+            if not self._restart:
+                self._restart = GObject.timeout_add(int(self.restart_delay_sec * 1000), self._restart_pipeline)
+        else:
+            logger.error('Replacement capture pipeline %s, keeping the running pipeline', reason)
+            self._config.update(self._current.settings)
+            self._set_state_internal(force=True)
+
+    def _stop_pipeline(self, p):
+        p.pipeline.get_bus().remove_signal_watch()
+        p.pipeline.set_state(Gst.State.NULL)
+
+    def _restart_pipeline(self):
+        self._restart = None
+        try:
+            self._start_pipeline()
+        except GLib.Error:
+            logger.error('Failed to restart capture pipeline: %s', sys.exc_info()[1])
+            self._restart = GObject.timeout_add(int(self.restart_delay_sec * 1000), self._restart_pipeline)
+        return False
+
+    def _on_pipeline_failed(self, reason):
+        """Watchdog for errors and EOS, the recording is aborted and capture is
+           restarted with a new pipeline
+        """
+        logger.error('Capture pipeline %s, restarting', reason)
+        self._current.failed = True
+        if self._state.state == 'DETECT_START':
+            self._activity_detected = False
+            self._stop_recording('timeout')
+        if not self._restart:
+            self._restart = GObject.timeout_add(int(self.restart_delay_sec * 1000), self._restart_pipeline)
+
+    def set_state(self, state):
+        changes = {}
+        for (k, v) in state.items():
+            if k not in self.live_settings + self.rebuild_settings:
+                raise service.ServiceMalformedDataObject
+            try:
+                if schema['snowboy'][k]['type'] == bool and isinstance(v, str):
+                    changes[k] = v.lower() in ['yes', 'true', 'high', 'on']
+                else:
+                    changes[k] = schema['snowboy'][k]['type'](v)
+            except (TypeError, ValueError):
+                raise service.ServiceMalformedDataObject
+            if k in self.rebuild_settings and not os.path.isfile(models_dir + changes[k]):
+                raise service.ServiceResourceException('No such {} file: {}'.format(k, changes[k]))
+        previous = self._config
+        self._config = dict(self._config, **changes)
+        rebuild = any(k in changes for k in self.rebuild_settings)
+        # Enabling vad_adaptive needs the level element, which is only added to
+        # the pipeline when it is built with vad_adaptive or gate enabled
+        if self._config['vad_adaptive'] and not self._lv and '{level}' in self._config['pipeline']:
+            rebuild = True
+        if rebuild:
+            if self._state.state == 'LISTENING':
+                try:
+                    self._start_pipeline()
+                except GLib.Error:
+                    self._config = previous
+                    raise service.ServiceResourceException('Failed to build pipeline: {}'.format(sys.exc_info()[1]))
+            else:
+                self._rebuild = True
+        if 'sensitivity' in changes:
+            self._sb.set_property('sensitivity', self._config['sensitivity'])
+        if 'vad_hysteresis' in changes:
+            self._rm.set_property('hysteresis', self._config['vad_hysteresis'])
+        if 'vad_threshold_db' in changes or 'vad_adaptive' in changes:
+            self._vad_threshold = self._config['vad_threshold_db']
+            self._rm.set_property('threshold', self._vad_threshold)
+        logger.info('Detector settings changed: %s', changes)
         self._set_state_internal(force=True)
 
-    def _on_bus_message(self, _, message):
-        if message.type == Gst.MessageType.ELEMENT and message.src == self._rm:
+    def _on_new_sample(self, sink):
+        """Hands the buffer memory to the consumer of the port's channel, this
+           runs on the pipeline's streaming thread
+        """
+        buf = sink.emit('pull-sample').get_buffer()
+        (ok, info) = buf.map(Gst.MapFlags.READ)
+        if ok:
+            try:
+                service.ServiceChannelRegistry.send(self._config['port'], info.data)
+            finally:
+                buf.unmap(info)
+        return Gst.FlowReturn.OK
+
+    def _preroll_probe(self, pad, info, p):
+        """Keeps the last preroll_sec of audio ahead of the gate.  When a hotword
+           is detected the pre-roll is sent and the gate opened from here, on the
+           streaming thread, so no audio is lost or reordered.
+        """
+        if p.preroll_limit is None:
+            s = pad.get_current_caps().get_structure(0)
+            width = int(re.sub(r'\D', '', s.get_value('format')))
+            p.preroll_limit = int(self._config['preroll_sec'] * s.get_value('rate')) * \
+                s.get_value('channels') * width // 8
+        if p.preroll_flush:
+            p.preroll_flush = False
+            for data in p.preroll:
+                self._send(p, data)
+            p.preroll.clear()
+            p.preroll_bytes = 0
+            p.rm.set_property('gate', False)
+            return Gst.PadProbeReturn.OK
+        buf = info.get_buffer()
+        data = buf.extract_dup(0, buf.get_size())
+        p.preroll.append(data)
+        p.preroll_bytes += len(data)
+        while p.preroll_bytes - len(p.preroll[0]) >= p.preroll_limit:
+            p.preroll_bytes -= len(p.preroll.popleft())
+        return Gst.PadProbeReturn.OK
+
+    def _on_sync_message(self, _, message, p):
+        """Level messages are posted from the streaming thread before the buffer
+           that completes the interval is pushed on to snowboy
+        """
+        if message.src == p.lv:
+            rms = self._level_rms(message.get_structure().to_string())
+            if rms is not None and rms > self._config['gate_threshold_db']:
+                p.gate_remaining = self._config['gate_hangover_sec']
+
+    def _gate_probe(self, pad, info, p):
+        """Only feeds snowboy while there is acoustic activity, or while an
+           utterance is being recorded.  Otherwise the last gate_lookback_sec of
+           audio is held back and pushed ahead of the audio that opens the gate.
+        """
+        if p.gate_pushing:
+            return Gst.PadProbeReturn.OK
+        buf = info.get_buffer()
+        duration = self._buffer_sec(pad, buf)
+        current = p is self._current
+        if current:
+            self._total_sec += duration
+        p.gate_remaining -= duration
+        if p.gate_remaining > 0 or self._state.state != 'LISTENING':
+            if p.gate:
+                p.gate_pushing = True
+                try:
+                    while p.gate:
+                        pad.push(p.gate.popleft())
+                finally:
+                    p.gate_pushing = False
+                if current:
+                    self._fed_sec += p.gate_sec
+                p.gate_sec = 0.0
+            if current:
+                self._fed_sec += duration
+            return Gst.PadProbeReturn.OK
+        p.gate.append(buf.copy())
+        p.gate_sec += duration
+        while p.gate_sec > self._config['gate_lookback_sec'] and len(p.gate) > 1:
+            p.gate_sec -= self._buffer_sec(pad, p.gate.popleft())
+        return Gst.PadProbeReturn.DROP
+
+    @staticmethod
+    def _buffer_sec(pad, buf):
+        if buf.duration != Gst.CLOCK_TIME_NONE:
+            return buf.duration / Gst.SECOND
+        s = pad.get_current_caps().get_structure(0)
+        width = int(re.sub(r'\D', '', s.get_value('format')))
+        return buf.get_size() / (s.get_value('rate') * s.get_value('channels') * width // 8)
+
+    def _udp_address(self, pipeline):
+        """The pre-roll is sent to wherever the pipeline's udpsink sends the
+           rest of the utterance, which may be a remote host
+        """
+        for e in pipeline.iterate_sinks():
+            if e.get_factory().get_name() == 'udpsink':
+                return (e.get_property('host'), e.get_property('port'))
+        return ('127.0.0.1', self._config['port'])
+
+    def _send(self, p, data):
+        if self._udp:
+            self._udp.sendto(data, p.address)
+        else:
+            service.ServiceChannelRegistry.send(self._config['port'], data)
+
+    def _on_bus_message(self, _, message, p):
+        if p is self._pending:
+            if message.type == Gst.MessageType.STATE_CHANGED and message.src == p.pipeline:
+                if message.parse_state_changed()[1] == Gst.State.PLAYING:
+                    self._on_pipeline_playing(p)
+            elif message.type == Gst.MessageType.ERROR:
+                self._on_pending_failed(p, 'error: {}'.format(message.parse_error()[0].message))
+            elif message.type == Gst.MessageType.EOS:
+                self._on_pending_failed(p, 'ended')
+            return
+        if p is not self._current:
+            return
+        if message.type == Gst.MessageType.ERROR:
+            self._on_pipeline_failed('error: {}'.format(message.parse_error()[0].message))
+        elif message.type == Gst.MessageType.EOS:
+            self._on_pipeline_failed('ended')
+        elif message.type == Gst.MessageType.ELEMENT and message.src == self._lv:
+            self._on_level(message)
+        elif message.type == Gst.MessageType.ELEMENT and message.src == self._rm:
             s = message.get_structure().to_string()
             if 'silence_detected' in s:
                 self._vad_silence_detected()
@@ -49,26 +383,65 @@ class SnowboyHotwordDetector(service.ServiceResource):
                 self._vad_silence_finished()
                 logger.info('vad active')
 
+    def _on_level(self, message):
+        """Keeps the levels heard while listening, the noise floor is taken as
+           a low percentile of these so speech and the hotword don't raise it
+        """
+        if not self._config['vad_adaptive'] or self._state.state != 'LISTENING':
+            return
+        rms = self._level_rms(message.get_structure().to_string())
+        if rms is not None:
+            self._noise.append(rms)
+
+    @staticmethod
+    def _level_rms(s):
+        rms = re.search(r'rms=\([^)]*\)[{<] *([^,}>]+)', s)
+        return float(rms.group(1)) if rms else None
+
+    def _adapt_vad_threshold(self):
+        if not self._noise:
+            return
+        levels = sorted(x for x in self._noise if x > -200)
+        if not levels:
+            return
+        self._noise_floor = round(levels[len(levels) // 5], 1)
+        self._vad_threshold = max(self._config['vad_threshold_db'],
+                                  int(round(self._noise_floor + self._config['vad_adaptive_margin_db'])))
+        self._rm.set_property('threshold', self._vad_threshold)
+        logger.debug('noise floor %s dB, vad threshold %s dB', self._noise_floor, self._vad_threshold)
+
     def _vad_timeout(self):
         if not self._activity_detected:
             logger.info('vad timeout')
+            Timeline.mark(self._utterance, 'vad_timeout')
             self._stop_recording('timeout')
         self._timeout = None
         return False
 
     def _vad_silence_detected(self):
+        if self._activity_detected:
+            Timeline.mark(self._utterance, 'vad_stop')
         self._stop_recording('silence')
 
     def _vad_silence_finished(self):
+        Timeline.mark(self._utterance, 'speech')
         self._activity_detected = True
         self._rm.set_property('minimum-silence-time', int(self._config['vad_min_silence_period_sec'] * 1000000000))
 
     def _on_hotword_detect(self, obj, index):
+        if obj is not self._sb:
+            return
         logger.info('hotword detected')
+        self._utterance = Timeline.start()
+        if self._config['vad_adaptive']:
+            self._adapt_vad_threshold()
         self._set_state_internal(state='DETECT_START')
         self._activity_detected = False
         self._sb.set_property('listen', False)
-        self._rm.set_property('gate', False)
+        if self._config['preroll_sec'] > 0:
+            self._current.preroll_flush = True
+        else:
+            self._rm.set_property('gate', False)
         self._rm.set_property('silent', False)
         self._timeout = GObject.timeout_add(int(self._config['vad_max_silence_period_sec']*1000), self._vad_timeout)
 
@@ -84,10 +457,16 @@ class SnowboyHotwordDetector(service.ServiceResource):
                 GObject.source_remove(self._timeout)
                 self._timeout = None
             self._sb.set_property('listen', True)
+            self._current.preroll_flush = False
             self._rm.set_property('gate', True)
             self._rm.set_property('silent', True)
             self._rm.set_property('minimum-silence-time', 0)
             self._set_state_internal(state='LISTENING')
+            if self._rebuild:
+                self._rebuild = False
+                self._restart_pipeline()
+            elif self._pending and self._pending.playing:
+                self._replace_pipeline()
 
     def _set_state_internal(self, state=None, force=False):
         try:
@@ -100,4 +479,8 @@ class SnowboyHotwordDetector(service.ServiceResource):
                 service.ServiceStateChangeRegistry.notify(self._path, self.get_state())
 
     def get_state(self):
-        return { 'state': self._state.state }
+        return { 'state': self._state.state, 'utterance': self._utterance,
+                 'noise_floor_db': self._noise_floor, 'vad_threshold_db': self._vad_threshold,
+                 'gate': { 'fed_sec': round(self._fed_sec, 1), 'total_sec': round(self._total_sec, 1),
+                           'duty_cycle': round(self._fed_sec / self._total_sec, 3) if self._total_sec else None },
+                 'settings': { k: self._config[k] for k in self.live_settings + self.rebuild_settings } }
@@ -1,4 +1,5 @@
 from . import service
+from .latency import Timeline
 import logging
 import spotipy
 from nested_lookup import nested_lookup
@@ -10,6 +11,8 @@ logger = logging.getLogger(__name__)
 
 
 class SpotifyService(service.ServiceResource):
+    blocking = True
+
     def __init__(self, config):
         super().__init__(config['path'])
         self._config = config
@@ -18,8 +21,8 @@ class SpotifyService(service.ServiceResource):
         self._state = service.ServiceStateMachine(['READY'], default_state='READY')
         self._now_playing = {}
         self._set_state_internal(force=True)
-        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent')
-        service.ServiceStateChangeRegistry.register(self._proxy, '/input')
+        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent', fields={'state': {'INTENT'}})
+        service.ServiceStateChangeRegistry.register(self._proxy, '/input', fields={'state': {'ACTION'}})
         scope = 'user-read-playback-state,user-modify-playback-state,user-read-currently-playing'
         self._auth = SpotifyOAuth(self._config['client_id'],
                                   self._config['client_secret'],
@@ -38,7 +41,8 @@ class SpotifyService(service.ServiceResource):
 
     def notify(self, path, state):
         if path == '/speech/intent' and state['state'] == 'INTENT':
-            self._proxy.handle_intent(state['intent'].get('intents', []), state['intent'].get('entities', {}))
+            self._proxy.handle_intent(state['intent'].get('intents', []), state['intent'].get('entities', {}),
+                                      state.get('utterance'))
         elif path == '/input' and state['state'] == 'ACTION':
             self._proxy.handle_input_action(state['action'])
 
@@ -58,7 +62,7 @@ class SpotifyService(service.ServiceResource):
             else:
                 logger.warn('ignoring "%s" action', action)                
 
-    def handle_intent(self, intents, entities):
+    def handle_intent(self, intents, entities, utterance=None):
         for intent in intents:
             action = intent['name']
             logger.debug('intent=%s', intent)
@@ -84,6 +88,7 @@ class SpotifyService(service.ServiceResource):
                 self._loop_music()
             else:
                 logger.warn('ignoring "%s" intent', action)
+        Timeline.mark(utterance, 'spotify_action')
 
     def setup_device(self):
         devices = self._client.devices()
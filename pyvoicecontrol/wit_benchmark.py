@@ -0,0 +1,274 @@
+"""End-to-end speech intent benchmark.  A corpus of WAV utterances is replayed
+   into the WitAISpeechService UDP port while driving the /speech/detector state
+   transitions, with a local HTTP server standing in for wit.ai.
+"""
+import argparse
+import glob
+import http.server
+import io
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+import tracemalloc
+import wave
+
+import pykka
+
+from gi import require_version
+require_version('Gst', '1.0')
+from gi.repository import Gst, GObject
+
+from pyvoicecontrol import config, schema, service, witservice
+
+
+logger = logging.getLogger(__name__)
+
+
+class MockWitHandler(http.server.BaseHTTPRequestHandler):
+    """Answers /speech requests like wit.ai after a configurable delay, failing
+       a configurable fraction of them
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        size = self._read_body()
+        self.server.requests += 1
+        self.server.bytes_received += size
+        time.sleep(max(0, random.gauss(self.server.latency_ms, self.server.jitter_ms)) / 1000)
+        if random.random() < self.server.error_rate:
+            self._respond(500, {'error': 'injected error', 'code': 'internal'})
+        else:
+            self._respond(200, {'text': 'benchmark', 'intents': [{'name': 'benchmark', 'confidence': 1.0}],
+                                'entities': {}, 'traits': {}})
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            size = 0
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+        return len(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def _respond(self, code, body):
+        data = json.dumps(body).encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockWitServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0):
+        super().__init__(('127.0.0.1', 0), MockWitHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.bytes_received = 0
+        self._thread = threading.Thread(target=self.serve_forever, name='MockWitServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/speech'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class BenchmarkListener(service.ServiceResource):
+    """Timestamps the /speech/intent state changes"""
+    def __init__(self, events):
+        super().__init__('/benchmark')
+        self._events = events
+
+    def on_start(self):
+        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/intent', fields={'state': {'INTENT', 'IDLE'}})
+
+    def notify(self, path, state):
+        self._events.put((time.perf_counter(), state['state']))
+
+    def get_state(self):
+        return {}
+
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def load_corpus(directory, rate, bits):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.wav'))):
+        with wave.open(path, 'rb') as f:
+            if f.getnchannels() != 1 or f.getframerate() != rate or f.getsampwidth() != bits // 8:
+                logger.warning('Skipping %s, must be mono %s bit %s Hz', path, bits, rate)
+                continue
+            corpus.append((os.path.basename(path), f.readframes(f.getnframes())))
+    return corpus
+
+
+class WitBenchmark():
+    def __init__(self, cfg, realtime=False, frame_ms=10, timeout=30):
+        self._cfg = cfg
+        self._realtime = realtime
+        self._frame_bytes = int(cfg['rate'] * frame_ms / 1000) * cfg['bits'] // 8
+        self._frame_sec = frame_ms / 1000
+        self._timeout = timeout
+        self._events = queue.Queue()
+        self._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._utterance = 0
+
+    def run(self, corpus, repeat=1):
+        results = []
+        listener = BenchmarkListener.start(self._events)
+        witservice.WitAISpeechService.start(self._cfg)
+        try:
+            # Wait for the service to notify its initial state
+            self._events.get(timeout=self._timeout)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for (name, audio) in corpus:
+                    results.append(self._utter(name, audio))
+            elapsed = time.perf_counter() - start
+        finally:
+            listener.stop()
+            pykka.ActorRegistry.stop_all()
+        return (results, elapsed)
+
+    def _detector(self, state):
+        service.ServiceStateChangeRegistry.notify('/speech/detector', {'state': state, 'utterance': self._utterance})
+
+    def _received_bytes(self):
+        return service.ServiceResourceRegistry.get_resource(self._cfg['path'])['capture']['received_bytes']
+
+    def _utter(self, name, audio):
+        while not self._events.empty():
+            self._events.get()
+        self._utterance += 1
+        # Restarted rather than reset_peak(), which needs python 3.9, so the peak
+        # only covers this utterance
+        tracemalloc.stop()
+        tracemalloc.start()
+        received = self._received_bytes()
+        self._detector('DETECT_START')
+        for offset in range(0, len(audio), self._frame_bytes):
+            self._socket.sendto(audio[offset:offset + self._frame_bytes], ('127.0.0.1', self._cfg['port']))
+            if self._realtime:
+                time.sleep(self._frame_sec)
+        # Don't stop until all the audio has been read from the socket
+        deadline = time.monotonic() + self._timeout
+        while self._received_bytes() < received + len(audio) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        stop = time.perf_counter()
+        self._detector('DETECT_STOP')
+        (intent, latency) = (False, None)
+        while True:
+            try:
+                (t, state) = self._events.get(timeout=self._timeout)
+            except queue.Empty:
+                break
+            if t < stop:
+                continue
+            if state == 'INTENT':
+                intent = True
+                latency = (t - stop) * 1000
+            elif state == 'IDLE':
+                latency = latency if intent else (t - stop) * 1000
+                break
+        self._detector('LISTENING')
+        peak = tracemalloc.get_traced_memory()[1]
+        return {'name': name, 'ok': intent, 'latency_ms': latency, 'audio_sec': len(audio) / (self._frame_bytes / self._frame_sec),
+                'peak_memory_bytes': peak}
+
+
+def report(results, elapsed, server):
+    latencies = [x['latency_ms'] for x in results if x['ok']]
+    audio_sec = sum(x['audio_sec'] for x in results)
+    return {
+        'utterances': len(results),
+        'errors': len([x for x in results if not x['ok']]),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'utterances_per_sec': len(results) / elapsed if elapsed else None,
+        'realtime_factor': audio_sec / elapsed if elapsed else None,
+        'peak_memory_bytes': max([x['peak_memory_bytes'] for x in results], default=0),
+        'mean_memory_bytes': sum(x['peak_memory_bytes'] for x in results) / len(results) if results else 0,
+        'requests': server.requests,
+        'bytes_sent': server.bytes_received,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the speech intent service against a local wit.ai stand-in')
+    parser.add_argument('--corpus', required=True, help='directory of WAV utterances')
+    parser.add_argument('--config_file', type=argparse.FileType('r'), help='take [wit_speech] settings from this file')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--latency_ms', type=float, default=300)
+    parser.add_argument('--jitter_ms', type=float, default=50)
+    parser.add_argument('--error_rate', type=float, default=0)
+    parser.add_argument('--realtime', action='store_true', help='send audio at capture speed')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--json', type=argparse.FileType('w'), help='write the report and per-utterance results here')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s\t%(module)s\t%(levelname)s\t%(message)s', level=logging.WARNING)
+    Gst.init(None)
+    loop = GObject.MainLoop()
+    threading.Thread(target=loop.run, name='MainLoop', daemon=True).start()
+
+    cfg = config.parse_config(args.config_file or io.StringIO('[wit_speech]\ntoken = benchmark\n'),
+                              {'wit_speech': schema.schema['wit_speech']})['wit_speech']
+    server = MockWitServer(args.latency_ms, args.jitter_ms, args.error_rate)
+    cfg.update(url=server.url, token='benchmark', port=args.port, transport='udp', archive_dir='')
+
+    corpus = load_corpus(args.corpus, cfg['rate'], cfg['bits'])
+    if not corpus:
+        print('No usable WAV files in {}'.format(args.corpus))
+        sys.exit(1)
+
+    tracemalloc.start()
+    try:
+        (results, elapsed) = WitBenchmark(cfg, realtime=args.realtime, timeout=cfg['timeout'] + 5).run(corpus, args.repeat)
+    finally:
+        tracemalloc.stop()
+        server.stop()
+        loop.quit()
+
+    summary = report(results, elapsed, server)
+    for (k, v) in summary.items():
+        print('{:20} {}'.format(k, round(v, 1) if isinstance(v, float) else v))
+    if args.json:
+        json.dump({'summary': summary, 'results': results}, args.json, indent=2)
+
+
+if __name__ == "__main__":
+    main()
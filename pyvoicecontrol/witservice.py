@@ -1,76 +1,482 @@
 import logging
+import queue
 import requests
 import socket
 import sys
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from nested_lookup import nested_alter
 
-from gi.repository import GObject
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from gi import require_version
+require_version('Gst', '1.0')
+from gi.repository import Gst, GObject
 
 from . import service
+from .archive import UtteranceArchive
+from .latency import Timeline
 
 
 logger = logging.getLogger(__name__)
 
 
+class WitStreamCancelled(Exception):
+    pass
+
+
+def analyse_audio(audio, dtype, rate, threshold_db=-45, padding_sec=0.1, frame_sec=0.02):
+    """Finds the byte range of audio left after trimming leading and trailing
+       frames quieter than threshold_db, and measures the utterance.  Levels are
+       relative to full scale, the SNR is estimated from loud and quiet frames.
+    """
+    samples = numpy.frombuffer(audio, dtype=dtype)
+    x = samples.astype(numpy.float32) / numpy.iinfo(dtype).max
+    frame = max(1, int(rate * frame_sec))
+    n = len(x) // frame
+    if n == 0:
+        return (0, len(audio), {})
+    energy_db = 10 * numpy.log10(numpy.mean(numpy.square(x[:n * frame].reshape(n, frame)), axis=1) + 1e-10)
+    voiced = numpy.flatnonzero(energy_db > threshold_db)
+    (first, last) = (0, n)
+    if voiced.size:
+        padding = int(padding_sec / frame_sec)
+        first = max(0, int(voiced[0]) - padding)
+        last = min(n, int(voiced[-1]) + 1 + padding)
+    start = first * frame * dtype.itemsize
+    end = len(audio) if last == n else last * frame * dtype.itemsize
+    stats = {
+        'duration_ms': round(1000 * len(x) / rate),
+        'trimmed_ms': round(1000 * (len(audio) - end + start) / dtype.itemsize / rate),
+        'rms_dbfs': round(10 * float(numpy.log10(numpy.mean(numpy.square(x)) + 1e-10)), 1),
+        'peak_dbfs': round(20 * float(numpy.log10(numpy.max(numpy.abs(x)) + 1e-10)), 1),
+        'clipped_ratio': round(float(numpy.count_nonzero(numpy.abs(x) >= 1.0)) / len(x), 4),
+        'snr_db': round(float(numpy.percentile(energy_db, 90) - numpy.percentile(energy_db, 10)), 1),
+    }
+    return (start, end, stats)
+
+
+class WitHTTPAdapter(HTTPAdapter):
+    """Enables TCP keepalive on pooled connections so idle connections that the
+       network has dropped are detected rather than failing the next request
+    """
+    def __init__(self, keepalive_sec, **kwargs):
+        self._socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if keepalive_sec > 0 and hasattr(socket, 'TCP_KEEPIDLE'):
+            self._socket_options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(keepalive_sec))),
+                                     (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(keepalive_sec)))]
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self._socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class WitEncoder(object):
+    """Compresses raw PCM in-process with an appsrc ! encoder ! appsink pipeline.
+       Encoded data is pulled from the same thread that pushes the audio.
+    """
+    encoders = {
+        'flac': ('flacenc ! oggmux', 'audio/ogg'),
+        'opus': ('audioresample ! opusenc bitrate=24000 ! oggmux', 'audio/ogg'),
+    }
+
+    def __init__(self, compression, bits, rate, endian):
+        (encoder, self.content) = self.encoders[compression]
+        fmt = 'S{}{}'.format(bits, '' if bits == 8 else 'LE' if endian == 'little' else 'BE')
+        self._frame_bytes = bits // 8
+        self._rate = rate
+        self._samples = 0
+        self._pipeline = Gst.parse_launch(
+            'appsrc name=src format=time caps=audio/x-raw,format={},rate={},channels=1,layout=interleaved ! '
+            'audioconvert ! {} ! appsink name=sink sync=false'.format(fmt, rate, encoder))
+        self._src = self._pipeline.get_by_name('src')
+        self._sink = self._pipeline.get_by_name('sink')
+        self._pipeline.set_state(Gst.State.PLAYING)
+
+    def push(self, data):
+        buf = Gst.Buffer.new_wrapped(bytes(data))
+        samples = len(data) // self._frame_bytes
+        buf.pts = Gst.util_uint64_scale(self._samples, Gst.SECOND, self._rate)
+        buf.duration = Gst.util_uint64_scale(samples, Gst.SECOND, self._rate)
+        self._samples += samples
+        self._src.emit('push-buffer', buf)
+
+    def end(self):
+        self._src.emit('end-of-stream')
+
+    def pull(self, timeout=Gst.CLOCK_TIME_NONE):
+        """Yields encoded data until none arrives within timeout, or the end of
+           the stream if no timeout is given
+        """
+        while True:
+            sample = self._sink.emit('try-pull-sample', timeout)
+            if sample is None:
+                return
+            buf = sample.get_buffer()
+            yield buf.extract_dup(0, buf.get_size())
+
+    def close(self):
+        self._pipeline.set_state(Gst.State.NULL)
+
+
 class WitAISpeechService(service.ServiceResource):
+    cache_state = False
+
     def __init__(self, config):
         super().__init__(config['path'])
         self._state = service.ServiceStateMachine(['IDLE', 'POSTING', 'INTENT'], default_state='IDLE')
         self._intent = {}
+        self._upload_info = {}
+        self._audio_info = {}
+        self._utterance = None
+        self._intent_utterance = None
         self._config = config
 
     def on_start(self):
-        self._buffered_audio = bytes()
-        self._fd = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        self._fd.bind(('', self._config['port']))
-        GObject.io_add_watch(self._fd.fileno(), GObject.IO_IN, self.io_handler)
+        # Audio is captured straight into a preallocated buffer big enough for
+        # the longest utterance we accept, anything beyond that is dropped.  There
+        # are two buffers so one can be uploaded while the other is captured.
+        self._sample_bytes = self._config['bits'] // 8
+        self._dtype = None
+        if numpy:
+            self._dtype = numpy.dtype('{}i{}'.format('<' if self._config['endian'] == 'little' else '>', self._sample_bytes))
+        elif self._config['trim_silence']:
+            logger.warning('numpy is not installed, silence is not trimmed')
+        capacity = int(self._config['max_utterance_sec'] * self._config['rate']) * self._sample_bytes
+        self._buffers = [memoryview(bytearray(capacity)) for _ in range(2)]
+        self._audio = self._buffers[0]
+        self._audio_len = 0
+        self._overrun_bytes = 0
+        self._received_total = 0
+        self._overrun_total = 0
+        # Big enough for any UDP datagram
+        self._scratch = bytearray(65536)
+        self._stream = None
+        self._request_id = 0
+        self._upload = None
+        self._executor = ThreadPoolExecutor(max_workers=3)
+        self._archive = None
+        self._archive_name = None
+        if self._config['archive_dir']:
+            self._archive = UtteranceArchive(self._config['archive_dir'], self._config['archive_max_files'],
+                                             self._config['archive_max_bytes'], self._config['bits'],
+                                             self._config['rate'], self._config['endian'])
+        self._session = self._create_session()
+        self._executor.submit(self._prewarm)
+        self._keepalive = None
+        if self._config['keepalive_sec'] > 0:
+            self._keepalive = GObject.timeout_add(int(self._config['keepalive_sec'] * 1000), self._keepalive_timeout)
+        self._fd = None
+        if self._config['transport'] == 'appsink':
+            service.ServiceChannelRegistry.connect(self._config['port'], self._receive)
+        else:
+            self._fd = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            self._fd.bind(('', self._config['port']))
+            GObject.io_add_watch(self._fd.fileno(), GObject.IO_IN, self.io_handler)
         self._set_state_internal(force=True)
-        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/detector')
+        service.ServiceStateChangeRegistry.register(self._proxy, '/speech/detector',
+                                                    fields={'state': {'DETECT_START', 'DETECT_STOP', 'DETECT_ABORT', 'LISTENING'}})
+
+    def on_stop(self):
+        if self._keepalive:
+            GObject.source_remove(self._keepalive)
+        if self._fd:
+            self._fd.close()
+        else:
+            service.ServiceChannelRegistry.disconnect(self._config['port'], self._receive)
+        self._preempt()
+        self._executor.shutdown(wait=False)
+        if self._archive:
+            self._archive.stop()
+        self._session.close()
+        service.ServiceResource.on_stop(self)
 
     def io_handler(self, fd, flags):
-        msg, _ = self._fd.recvfrom(1024*1024)
-        self._buffered_audio += msg
-        logger.debug('rx data length %s bytes', len(msg))
+        free = self._audio[self._audio_len:]
+        if len(free) >= len(self._scratch):
+            n = self._fd.recv_into(free)
+            self._received(n, n)
+        else:
+            # A datagram bigger than the space left would be truncated, so near
+            # the end of the buffer it's read whole and only what fits is kept
+            n = self._fd.recv_into(self._scratch)
+            kept = min(n, len(free))
+            free[:kept] = self._scratch[:kept]
+            self._received(n, kept)
+        logger.debug('rx data length %s bytes', n)
         return True
 
+    def _receive(self, data):
+        """Receives audio handed over in-process, on the sender's thread"""
+        free = self._audio[self._audio_len:]
+        n = min(len(data), len(free))
+        free[:n] = data[:n]
+        self._received(len(data), n)
+
+    def _received(self, length, kept):
+        self._audio_len += kept
+        self._overrun_bytes += length - kept
+        self._received_total += length
+        self._overrun_total += length - kept
+        stream = self._stream
+        if stream and kept:
+            stream.put((self._audio_len, False))
+
     def notify(self, _, state):
-        if state['state'] == 'DETECT_STOP':
-            self.handle_request()
+        if state['state'] == 'DETECT_START':
+            # A new utterance takes over from any request still in flight
+            self._preempt()
+            self._utterance = state.get('utterance')
+            if self._config['streaming']:
+                self._start_stream()
+            else:
+                self._executor.submit(self._prewarm)
+        elif state['state'] == 'DETECT_STOP':
+            if self._stream:
+                self._finish_stream()
+            else:
+                self.handle_request()
+        elif state['state'] == 'DETECT_ABORT':
+            self._preempt()
         elif state['state'] == 'LISTENING':
-            self._buffered_audio = bytes()
+            self._audio_len = 0
+            self._overrun_bytes = 0
 
-    def handle_request(self):
+    def _next_buffer(self):
+        """Hands over the captured audio and captures into the other buffer"""
+        audio = self._audio
+        self._audio = self._buffers[1] if audio is self._buffers[0] else self._buffers[0]
+        return audio
 
-        if len(self._buffered_audio) == 0:
-            logger.warn('No audio buffered')
+    def _preempt(self):
+        """Cancels the request in flight.  A request that is already being sent
+           can't be interrupted, but its result is discarded when it arrives.
+        """
+        if self._stream:
+            logger.info('Cancelling wit stream')
+            self._stream.put((None, True))
+            self._stream = None
+        if self._upload and not self._upload.done():
+            logger.info('Preempting wit request')
+            self._upload.cancel()
+            self._upload = None
+            self._request_id += 1
+            self._set_state_internal(state='IDLE')
+
+    def _start_stream(self):
+        """Opens a chunked POST straight away and feeds it audio as it arrives.
+           The buffer was reset on LISTENING and may already hold the pre-roll.
+        """
+        self._stream = queue.Queue()
+        logger.info('Streaming to wit server')
+        stats = {}
+        self._submit(self._encode_audio(self._stream_audio(self._audio, self._stream), stats), stats, retry=False)
+
+    def _finish_stream(self):
+        self._stream.put((self._audio_len, True))
+        self._stream = None
+        length = max(0, self._audio_len - self._config['tail_discard_samples'] * self._sample_bytes)
+        audio = self._next_buffer()[:length]
+        if self._dtype:
+            self._audio_info = analyse_audio(audio, self._dtype, self._config['rate'],
+                                             self._config['trim_threshold_db'],
+                                             self._config['trim_padding_sec'])[2]
+        if self._archive:
+            self._archive_name = self._archive.add_audio(audio)
+
+    def _stream_audio(self, audio, stream):
+        """Yields audio from the capture buffer as it arrives.  The tail that is
+           discarded at the end of the utterance is held back until then.
+        """
+        tail = self._config['tail_discard_samples'] * self._sample_bytes
+        sent = 0
+        done = False
+        while not done:
+            (length, done) = stream.get()
+            if length is None:
+                raise WitStreamCancelled
+            if length - tail > sent:
+                yield audio[sent:length - tail]
+                sent = length - tail
+
+    def _encode_audio(self, chunks, stats):
+        """Compresses audio chunks as they arrive, keeping count of the bytes in
+           and out and the time spent encoding
+        """
+        stats.update(compression=self._config['compression'], raw_bytes=0, sent_bytes=0, encode_ms=0)
+        if self._config['compression'] == 'none':
+            for chunk in chunks:
+                stats['raw_bytes'] += len(chunk)
+                stats['sent_bytes'] += len(chunk)
+                yield chunk
             return
+        encoder = WitEncoder(self._config['compression'], self._config['bits'],
+                             self._config['rate'], self._config['endian'])
+        try:
+            for chunk in chunks:
+                start = time.monotonic()
+                encoder.push(chunk)
+                stats['raw_bytes'] += len(chunk)
+                stats['encode_ms'] += (time.monotonic() - start) * 1000
+                for data in encoder.pull(0):
+                    stats['sent_bytes'] += len(data)
+                    yield data
+            start = time.monotonic()
+            encoder.end()
+            data = b''.join(encoder.pull())
+            stats['encode_ms'] += (time.monotonic() - start) * 1000
+            stats['sent_bytes'] += len(data)
+            yield data
+        finally:
+            encoder.close()
+
+    def _submit(self, data, stats, retry=True):
+        self._request_id += 1
+        self._set_state_internal(state='POSTING')
+        self._upload = self._executor.submit(self._post_request, self._request_id, self._utterance, data, stats, retry)
 
-        self._buffered_audio = self._buffered_audio[:-(self._config['tail_discard_samples']*2)]
+    def _post_request(self, request_id, utterance, data, stats, retry):
+        """Runs on an executor thread, the result is passed back to the actor"""
+        try:
+            if retry:
+                # A request that may be retried must be sent from a buffer
+                data = b''.join(self._encode_audio([data], stats)) \
+                    if self._config['compression'] != 'none' else data
+                if not stats:
+                    stats.update(compression='none', raw_bytes=len(data), sent_bytes=len(data), encode_ms=0)
+            Timeline.mark(utterance, 'upload_start')
+            start = time.monotonic()
+            r = self._post(data, retry)
+            Timeline.mark(utterance, 'first_byte')
+            r.raise_for_status()
+            text = r.text
+            self._upload_stats(stats, (time.monotonic() - start) * 1000)
+            logger.debug('Got wit result %s', text)
+            self._proxy.handle_result(request_id, text, stats)
+        except WitStreamCancelled:
+            pass
+        except:
+            logger.error('Failed to post request: %s', sys.exc_info())
+            self._proxy.handle_result(request_id, None, stats)
 
-        token = self._config['token']
-        headers = {'Authorization': 'Bearer ' + token,
-                   'Content-Type': '{}; encoding={}; bits={}; rate={}; endian={}'.format(
-                       self._config['content'], self._config['encoding'], self._config['bits'],
-                       self._config['rate'], self._config['endian']
-                       )
-                   }
-        url = self._config['url']
+    def _upload_stats(self, stats, request_ms):
+        """Estimates the time saved by compression from the rate achieved for
+           the bytes that were sent
+        """
+        stats['request_ms'] = round(request_ms, 1)
+        stats['saved_bytes'] = stats['raw_bytes'] - stats['sent_bytes']
+        stats['saved_ms'] = round(request_ms * stats['saved_bytes'] / stats['sent_bytes'] - stats['encode_ms'], 1) \
+            if stats['sent_bytes'] else 0
+        stats['encode_ms'] = round(stats['encode_ms'], 1)
+        logger.info('Sent %s of %s bytes in %s ms, saved %s ms', stats['sent_bytes'], stats['raw_bytes'],
+                    stats['request_ms'], stats['saved_ms'])
 
+    def handle_result(self, request_id, result, stats):
+        if request_id != self._request_id:
+            logger.info('Discarding result of preempted request')
+            return
+        self._upload = None
+        self._upload_info = stats
+        if self._archive and self._archive_name:
+            # Parsed separately as _decode_result alters the intent in place
+            try:
+                response = json.loads(result)
+            except (TypeError, ValueError):
+                response = result
+            self._archive.add_result(self._archive_name, {'response': response, 'upload': stats, 'audio': self._audio_info})
+            self._archive_name = None
         try:
-            logger.info('Posting to wit server')
-            self._set_state_internal(state='POSTING')
-            r = requests.post(url, headers=headers, data=self._buffered_audio)
-            logger.debug('Got wit result %s', r.text)
-            self._decode_result(r.text)
-            self._set_state_internal(state='IDLE')
+            if result is not None:
+                self._intent_utterance = self._utterance
+                self._decode_result(result)
+                Timeline.mark(self._utterance, 'intent')
         except:
-            logger.error('Failed to post request:', sys.exc_info())
-            self._set_state_internal(state='IDLE')
+            logger.error('Failed to decode result: %s', sys.exc_info())
         finally:
-            if self._config['output_file']:
-                with open(self._config['output_file'], 'wb') as f:
-                    f.write(self._buffered_audio)
+            self._set_state_internal(state='IDLE')
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = WitHTTPAdapter(self._config['keepalive_sec'], pool_connections=1, pool_maxsize=3)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _reset_session(self):
+        session, self._session = self._session, self._create_session()
+        session.close()
+
+    def _prewarm(self):
+        """Opens or refreshes a pooled connection to the wit server, so the next
+           request skips the DNS lookup, TCP connect and TLS handshake
+        """
+        try:
+            self._session.head(self._config['url'], timeout=self._config['timeout'])
+        except requests.RequestException:
+            logger.debug('Failed to pre-warm connection: %s', sys.exc_info()[1])
+            self._reset_session()
+
+    def _keepalive_timeout(self):
+        self._executor.submit(self._prewarm)
+        return True
+
+    def _post(self, data, retry=True):
+        """A connection that has gone stale is replaced and, if the data can be
+           sent again, the request is retried once
+        """
+        timeout = self._config['timeout']
+        try:
+            return self._session.post(self._config['url'], headers=self._headers(), data=data, timeout=timeout, stream=True)
+        except requests.ConnectionError:
+            self._reset_session()
+            if not retry:
+                raise
+            logger.info('Reconnecting to wit server')
+            return self._session.post(self._config['url'], headers=self._headers(), data=data, timeout=timeout, stream=True)
+
+    def _headers(self):
+        if self._config['compression'] != 'none':
+            return {'Authorization': 'Bearer ' + self._config['token'],
+                    'Content-Type': WitEncoder.encoders[self._config['compression']][1]}
+        return {'Authorization': 'Bearer ' + self._config['token'],
+                'Content-Type': '{}; encoding={}; bits={}; rate={}; endian={}'.format(
+                    self._config['content'], self._config['encoding'], self._config['bits'],
+                    self._config['rate'], self._config['endian']
+                    )
+                }
+
+    def handle_request(self):
+
+        if self._audio_len == 0:
+            logger.warn('No audio buffered')
+            return
+
+        if self._overrun_bytes:
+            logger.warn('Utterance exceeded %s seconds, dropped %s bytes',
+                        self._config['max_utterance_sec'], self._overrun_bytes)
+
+        length = max(0, self._audio_len - self._config['tail_discard_samples'] * self._sample_bytes)
+        audio = self._next_buffer()[:length]
+
+        if self._dtype:
+            (start, end, self._audio_info) = analyse_audio(audio, self._dtype, self._config['rate'],
+                                                           self._config['trim_threshold_db'],
+                                                           self._config['trim_padding_sec'])
+            if self._config['trim_silence']:
+                audio = audio[start:end]
+
+        logger.info('Posting to wit server')
+        self._submit(audio, {})
+
+        if self._archive:
+            self._archive_name = self._archive.add_audio(audio)
 
     def _decode_result(self, result):
         intent = json.loads(result)
@@ -93,4 +499,9 @@ class WitAISpeechService(service.ServiceResource):
                 service.ServiceStateChangeRegistry.notify(self._path, self.get_state())
 
     def get_state(self):
-        return { 'state': self._state.state, 'intent': self._intent }
+        return { 'state': self._state.state, 'intent': self._intent, 'utterance': self._intent_utterance, 'upload': self._upload_info, 'audio': self._audio_info,
+                 'capture': { 'transport': self._config['transport'],
+                              'received_bytes': self._received_total,
+                              'overrun_bytes': self._overrun_total,
+                              'dropped_bytes': service.ServiceChannelRegistry.dropped(self._config['port']),
+                              'archive_dropped': self._archive.dropped if self._archive else 0 } }
@@ -28,10 +28,12 @@ setup(
                       'nested-lookup>=0.2.22',
                       'evdev>=1.4.0',
                       'pulsectl-asyncio>=0.1.5'],
-    extras_require={},
+    extras_require={'numpy': ['numpy>=1.16']},
     entry_points={
         'console_scripts': [
-            'pyvoicecontrol = pyvoicecontrol.__main__:main'
+            'pyvoicecontrol = pyvoicecontrol.__main__:main',
+            'pyvoicecontrol-wit-benchmark = pyvoicecontrol.wit_benchmark:main',
+            'pyvoicecontrol-hotword-benchmark = pyvoicecontrol.hotword_benchmark:main'
         ]
     },
 )